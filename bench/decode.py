@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+# Copyright (c) 2014 Chris Luke <chrisy@flirble.org>
+#
+"""
+How many server beacons a second protocol.decode() gets through,
+against building a protocol.PTP from each, for short and long client
+lists.
+
+    bench/decode.py [entries...]
+"""
+
+import os, sys, timeit
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ptptest import protocol
+
+
+def beacon(entries):
+    return protocol.encode(''.join([
+        protocol.encode_uint(protocol.PTP_TYPE_SERVERVER, 1, 2),
+        protocol.encode_uint(protocol.PTP_TYPE_SEQUENCE, 4, 77),
+        protocol.encode_string(protocol.PTP_TYPE_UUID, 'u' * 16),
+        protocol.encode_uint(protocol.PTP_TYPE_MYTS, 8, 1 << 60),
+        protocol.encode_address(protocol.PTP_TYPE_YOURADDR, ('9.8.7.6', 4000)),
+    ] + [
+        protocol.encode_address(protocol.PTP_TYPE_CLIENTLIST_EXT,
+                ('10.0.%d.%d' % (i / 250, i % 250), 1000 + i))
+        for i in xrange(entries)
+    ] + [
+        protocol.encode_uint(protocol.PTP_TYPE_CLIENTLEN, 1, entries),
+    ]))
+
+
+def objects(packet):
+    l = protocol.PTP(packet)
+    assert l.csum == l.buf_csum
+    return [(t.data.ptp_type, t.data.data) for t in l.data]
+
+
+if __name__ == "__main__":
+    for entries in [int(a) for a in sys.argv[1:]] or (4, 160):
+        packet = beacon(entries)
+        assert protocol.decode(packet) == objects(packet)
+        number = max(100, 20000 / (entries + 1))
+        for (name, f) in (("PTP()", lambda: objects(packet)),
+                ("decode()", lambda: protocol.decode(packet))):
+            t = min(timeit.repeat(f, number=number, repeat=3)) / number
+            print "%4d entries %5d bytes  %-9s %7.0f packets/s" % (
+                    entries, len(packet), name, 1 / t)
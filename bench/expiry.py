@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+# Copyright (c) 2014 Chris Luke <chrisy@flirble.org>
+#
+"""
+What finding the server's expired clients costs a tick, scanning them
+all as the server used to against taking them from a wheel.TimerWheel.
+
+    bench/expiry.py [clients...]
+"""
+
+import os, sys, time, random
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ptptest import wheel, peer
+from ptptest.server import CLIENT_TIMEOUT
+
+TICKS               = 20
+
+
+def per_tick(count, age):
+    """Milliseconds a tick for each, with clients last heard from up to
+    age seconds ago"""
+    now = 1000.0
+    clients = {}
+    expiry = wheel.TimerWheel()
+    for i in xrange(count):
+        sin = ('10.0.%d.%d' % (i >> 8 & 255, i & 255), 1000 + i)
+        clients[sin] = peer.Peer(sin, ts=now - random.uniform(0, age))
+        expiry.schedule(sin, clients[sin].ts + CLIENT_TIMEOUT)
+    expiry.expire(now)
+
+    t = time.time()
+    for tick in xrange(1, TICKS + 1):
+        ts = now + tick
+        [k for k in clients if clients[k].ts + CLIENT_TIMEOUT < ts]
+    scan = (time.time() - t) / TICKS
+
+    t = time.time()
+    for tick in xrange(1, TICKS + 1):
+        expiry.expire(now + tick)
+    wheeled = (time.time() - t) / TICKS
+    return (scan * 1000, wheeled * 1000)
+
+
+if __name__ == "__main__":
+    counts = [int(a) for a in sys.argv[1:]] or (1000, 10000, 50000)
+    random.seed(0)
+    for (age, title) in ((7, "all heard from in the last 7s (nothing due)"),
+            (40, "last heard from 0-40s ago (1 in 40 due a tick)")):
+        print "Clients %s:" % title
+        for count in counts:
+            print "  %6d clients  scan %8.3f ms  wheel %7.4f ms" % (
+                    (count,) + per_tick(count, age))
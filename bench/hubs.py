@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+# Copyright (c) 2014 Chris Luke <chrisy@flirble.org>
+#
+"""
+Compares the eventlet hubs --hub can choose: the CPU a headless server
+and client use while idle, then how many requests a second the server
+answers under ptpload. Linux only, as it reads /proc.
+
+    bench/hubs.py [port [hubs...]]
+"""
+
+import os, sys, re, time, signal, subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HUBS = ('epolls', 'poll', 'selects')
+IDLE_TIME           = 20
+LOAD_ARGS           = ('-c', '64', '-n', '2', '-t', '5')
+
+
+def start(prog, *args):
+    return subprocess.Popen((sys.executable, os.path.join(ROOT, prog), '--headless') + args,
+            stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+
+
+def ticks(proc):
+    """utime + stime of a process, in clock ticks"""
+    with open('/proc/%d/stat' % proc.pid) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return int(fields[11]) + int(fields[12])
+
+
+def stop(proc):
+    proc.send_signal(signal.SIGTERM)
+    for i in xrange(20):
+        if proc.poll() is not None:
+            return
+        time.sleep(0.1)
+    proc.kill()
+    proc.wait()
+
+
+def measure(port, hub):
+    server = start('ptpserver', '-p', str(port), '--hub', hub)
+    time.sleep(1)
+    client = start('ptpclient', '-s', '127.0.0.1', '-p', str(port), '--hub', hub)
+    try:
+        time.sleep(2)
+        before = (ticks(server), ticks(client))
+        time.sleep(IDLE_TIME)
+        idle = (ticks(server) - before[0], ticks(client) - before[1])
+    finally:
+        stop(client)
+    try:
+        out = subprocess.check_output((sys.executable, os.path.join(ROOT, 'ptpload'),
+                '-p', str(port)) + LOAD_ARGS)
+    finally:
+        stop(server)
+    answers = re.search(r'^(\d+) answers/s', out, re.M)
+    return idle + (int(answers.group(1)) if answers else 0,)
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 23457
+    hubs = sys.argv[2:] or HUBS
+    print "Idle CPU is in clock ticks over %ds; load is ptpload %s" % (
+            IDLE_TIME, ' '.join(LOAD_ARGS))
+    for hub in hubs:
+        print "%-8s idle server %3d, client %3d; %6d answers/s" % (
+                (hub,) + measure(port, hub))
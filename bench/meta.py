@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+# Copyright (c) 2014 Chris Luke <chrisy@flirble.org>
+#
+"""
+How big the client's META is, and what encoding and decoding it costs,
+as JSON and as BSON; then what a round of server beacons costs with
+each.
+
+    bench/meta.py [servers...]
+"""
+
+import os, sys, argparse, contextlib, json, timeit
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ptptest import client, protocol, peer, bson
+
+
+class Discard(object):
+    """Stands in for the DatagramIO"""
+
+    timestamps = False
+
+    def sendto(self, packet, sin):
+        pass
+
+    @contextlib.contextmanager
+    def batch(self):
+        yield
+
+
+def best(f, number=20000):
+    return min(timeit.repeat(f, number=number, repeat=5)) / number * 1e6
+
+
+def servers(count):
+    d = {}
+    for i in xrange(count):
+        sin = ('192.0.2.%d' % (i + 1), 23456)
+        p = peer.Peer(sin, name='ptp-mesh-server-%02d.lon1.example.net' % i,
+                ts=1700000000.123456 + i)
+        p.serverver = client.PTP_BSON_SERVERVER
+        p.sequence = 123456 + i
+        p.myts = 1700000000.1 + i
+        (p.sent, p.rcvd, p.ackd) = (123456, 123400, 123390)
+        p.add_rtt(0.000821345)
+        d[sin] = p
+    return d
+
+
+if __name__ == "__main__":
+    counts = [int(a) for a in sys.argv[1:]] or (1, 2)
+    encodings = (("JSON", protocol.PTP_TYPE_META,
+                lambda m: json.dumps(m, separators=(',', ':'))),
+            ("BSON", protocol.PTP_TYPE_META_BSON, bson.dumps))
+
+    for count in counts:
+        meta = dict(("%s-%d" % k, v.meta()) for (k, v) in servers(count).items())
+        for (name, ptp_type, dumps) in encodings:
+            data = dumps(meta)
+            if len(data) <= protocol.PTP_TLV_MAX:
+                packet = protocol.encode(protocol.encode_string(ptp_type, data))
+                decode = "decode %6.1f us" % best(lambda: protocol.decode(packet))
+            else:
+                decode = "too big for a TLV"
+            print "%d server(s) %s: %3d bytes, encode %6.1f us, %s" % (
+                    count, name, len(data), best(lambda: dumps(meta)), decode)
+
+    for binary in (False, True):
+        c = client.Client(argparse.Namespace(debug=False, hexdump=False,
+                stun=False, server='127.0.0.1', port=23456, mmsg=False, bson=binary))
+        c.io = Discard()
+        for count in counts:
+            c.servers = servers(count)
+            print "%s _server_beacons to %d server(s): %6.1f us" % (
+                    "BSON" if binary else "JSON", count, best(c._server_beacons, 5000))
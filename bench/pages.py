@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+# Copyright (c) 2014 Chris Luke <chrisy@flirble.org>
+#
+"""
+Simulate a server with thousands of registered clients sending its
+client list, in pages, to one client that loses some of them, and check
+that the client ends up knowing every other client, at the right
+address.
+
+    bench/pages.py [clients [nat [loss]]]
+
+One in every nat clients is behind the same NAT as the one we deliver
+to, so should be known by its internal address; loss is the fraction
+of packets that are dropped.
+"""
+
+import os, sys, random, argparse, contextlib
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ptptest import server, client, protocol
+
+NAT = '192.0.2.1'
+
+
+class Sent(object):
+    """Stands in for the DatagramIO, keeping what is sent"""
+
+    timestamps = False
+
+    def __init__(self):
+        self.packets = []
+
+    def sendto(self, packet, sin):
+        self.packets.append((packet, sin))
+
+    @contextlib.contextmanager
+    def batch(self):
+        yield
+
+
+def request(i, sin, ptpaddr):
+    return protocol.encode(''.join((
+        protocol.encode_uint(protocol.PTP_TYPE_CLIENTVER, 1, client.PTP_CLIENTVER),
+        protocol.encode_uint(protocol.PTP_TYPE_SEQUENCE, 4, 1),
+        protocol.encode_string(protocol.PTP_TYPE_UUID, '%016d' % i),
+        protocol.encode_address(protocol.PTP_TYPE_PTPADDR, ptpaddr),
+        protocol.encode_uint(protocol.PTP_TYPE_MYTS, 8, 1),
+    )))
+
+
+def simulate(count, nat, loss):
+    args = argparse.Namespace(debug=False, hexdump=False, stun=False,
+            server='127.0.0.1', port=0, mmsg=False)
+    s = server.Server(args)
+    s.io = Sent()
+
+    # Register them all; those behind our NAT share its address
+    internal = set()
+    for i in xrange(count):
+        ptpaddr = ('10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255), 5000)
+        if nat and i % nat == 0:
+            sin = (NAT, 1000 + i)
+            internal.add(ptpaddr)
+        else:
+            sin = (ptpaddr[0], 1000 + i % 5000)
+        s._read(request(i, sin, ptpaddr), sin)
+    target = (NAT, 1000) if nat else min(s.clients)
+    expect = count - 1
+
+    c = client.Client(argparse.Namespace(debug=False, hexdump=False, stun=False,
+            server='127.0.0.1', port=23456, mmsg=False))
+    c.io = Sent()
+    ssin = c.servers.keys()[0]
+
+    rounds = 0
+    while len(c.clients) < expect and rounds < 20:
+        rounds += 1
+        s.io.packets = []
+        s._client_beacon(target, s.clients[target])
+        pages = len(s.io.packets)
+        for (packet, sin) in s.io.packets:
+            if random.random() >= loss:
+                c._read(packet, ssin)
+
+    known = set(c.clients)
+    via = sum(1 for k in known if k in internal)
+    print "%d clients, 1 in %s behind our NAT, %d%% loss: %d pages a round, " \
+            "%d peers (%d by internal address) after %d rounds" % (
+            count, nat or 'none', loss * 100, pages, len(known), via, rounds)
+    return len(known) == expect and (not nat or via == len(internal) - 1)
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    if argv:
+        runs = [(int(argv[0]), int(argv[1]) if len(argv) > 1 else 0,
+                float(argv[2]) if len(argv) > 2 else 0.0)]
+    else:
+        runs = [(3000, 0, 0.0), (5000, 13, 0.2)]
+    random.seed(0)
+    ok = all([simulate(*run) for run in runs])
+    sys.exit(0 if ok else 1)
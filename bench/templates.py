@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+# Copyright (c) 2014 Chris Luke <chrisy@flirble.org>
+#
+"""
+What building the packets we send over and over costs: an echo built
+from protocol.PTP objects, as it used to be, encoded from its TLVs, and
+filled into a protocol.Template; then each of the client's and
+server's send paths as they are.
+
+    bench/templates.py [clients]
+
+clients is how many the server has registered, so how long the client
+list in its beacons is.
+"""
+
+import os, sys, argparse, contextlib, timeit
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ptptest import server, client, protocol, loadtest
+
+
+class Discard(object):
+    """Stands in for the DatagramIO"""
+
+    timestamps = False
+
+    def sendto(self, packet, sin):
+        pass
+
+    @contextlib.contextmanager
+    def batch(self):
+        yield
+
+
+def best(name, f, number=20000):
+    t = min(timeit.repeat(f, number=number, repeat=5)) / number
+    print "  %-28s %7.2f us" % (name, t * 1e6)
+
+
+def objects(seq, ts, rx, tx):
+    l = protocol.PTP(data=[])
+    l.data = [protocol.TLV(type=t, data=v) for (t, v) in (
+        (protocol.PTP_TYPE_CLIENTVER, protocol.UInt(size=1, data=client.PTP_CLIENTVER)),
+        (protocol.PTP_TYPE_SEQUENCE, protocol.UInt(size=4, data=seq)),
+        (protocol.PTP_TYPE_UUID, protocol.String(data='U' * 16)),
+        (protocol.PTP_TYPE_YOURTS, protocol.UInt(size=8, data=ts)),
+        (protocol.PTP_TYPE_RXTS, protocol.UInt(size=8, data=rx)),
+        (protocol.PTP_TYPE_TXTS, protocol.UInt(size=8, data=tx)),
+    )]
+    return l.pack()
+
+
+def encoded(seq, ts, rx, tx):
+    return protocol.encode(''.join((
+        protocol.encode_uint(protocol.PTP_TYPE_CLIENTVER, 1, client.PTP_CLIENTVER),
+        protocol.encode_uint(protocol.PTP_TYPE_SEQUENCE, 4, seq),
+        protocol.encode_string(protocol.PTP_TYPE_UUID, 'U' * 16),
+        protocol.encode_uint(protocol.PTP_TYPE_YOURTS, 8, ts),
+        protocol.encode_uint(protocol.PTP_TYPE_RXTS, 8, rx),
+        protocol.encode_uint(protocol.PTP_TYPE_TXTS, 8, tx),
+    )))
+
+
+def templated(template, seq, ts, rx, tx):
+    template.set('seq', seq)
+    template.set('ts', ts)
+    template.set('rx', rx)
+    template.set('tx', tx)
+    return template.packet()
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    args = argparse.Namespace(debug=False, hexdump=False, stun=False,
+            server='127.0.0.1', port=0, mmsg=False)
+
+    template = protocol.Template(
+        protocol.encode_uint(protocol.PTP_TYPE_CLIENTVER, 1, client.PTP_CLIENTVER),
+        ('seq', protocol.PTP_TYPE_SEQUENCE, 4),
+        protocol.encode_string(protocol.PTP_TYPE_UUID, 'U' * 16),
+        ('ts', protocol.PTP_TYPE_YOURTS, 8),
+        ('rx', protocol.PTP_TYPE_RXTS, 8),
+        ('tx', protocol.PTP_TYPE_TXTS, 8))
+    values = (123456, 1 << 60, 3 << 59, (3 << 59) + 12345)
+    assert str(templated(template, *values)) == encoded(*values) == objects(*values)
+    print "An echo with timestamps:"
+    best("built from PTP objects", lambda: objects(*values))
+    best("encoded from its TLVs", lambda: encoded(*values))
+    best("filled into a Template", lambda: templated(template, *values))
+
+    s = server.Server(args)
+    s.io = Discard()
+    for i in xrange(count):
+        sin = ('10.%d.%d.1' % (i // 250, i % 250), 4000 + i)
+        s._read(loadtest._request('%016d' % i, 1, sin, 1), sin)
+    k = min(s.clients)
+    cl = s.clients[k]
+
+    c = client.Client(argparse.Namespace(**dict(vars(args), port=23456)))
+    c.io = Discard()
+    c._client_add(('10.9.9.9', 5000), ('10.9.9.9', 5000))
+    p = c.clients[('10.9.9.9', 5000)]
+    srv = c.servers.values()[0]
+    srv.uuid = 'S' * 16
+
+    print "Send paths, a packet each:"
+    best("client _client_beacon", lambda: c._client_beacon(p))
+    best("client _client_respond", lambda: c._client_respond(p, 123456789, 987654321))
+    best("client _server_respond", lambda: c._server_respond(srv, 123456789, 987654321))
+    best("client _server_beacons", lambda: c._server_beacons(), 5000)
+    best("server _client_respond", lambda: s._client_respond(cl, 123456789, 987654321))
+    best("server _client_beacon (%d)" % count, lambda: s._client_beacon(k, cl), 5000)
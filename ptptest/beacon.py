@@ -0,0 +1,242 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+# Copyright (c) 2014 Chris Luke <chrisy@flirble.org>
+#
+"""PTP Server beacon encoder"""
+
+import random, collections
+import protocol
+
+# How many registry changes we remember for sending deltas
+CHANGE_LOG_SIZE = 4096
+
+# Generations go in 4 bytes; each cache starts its own at random in the
+# lower half, so that one a client has from another server instance is
+# not taken for ours, and starts again when they would wrap
+_GEN_MOD = 1 << 32
+
+
+class BeaconCache(object):
+    """Keeps the encoded client list entries for server beacons.
+
+    Each client's CLIENTLIST_EXT and CLIENTLIST_INT TLVs are encoded
+    once, when the client joins or its addresses change, and the list
+    sent to each client is then just a join (or slice) of those cached
+    segments.
+
+    Clients are also indexed by public address, so those behind the same
+    NAT, who get each other's internal address, are found without a
+    scan; the list for one of them is the EXT segments of everyone else
+    followed by those of its neighbours, both cached per address."""
+
+    def __init__(self):
+        super(BeaconCache, self).__init__()
+        self._ext = {}      # key -> encoded CLIENTLIST_EXT
+        self._int = {}      # key -> encoded CLIENTLIST_INT, may be ''
+        self._sin = {}      # key -> public address and port
+        self._groups = {}   # public address -> keys of its clients
+        self._gblob = {}    # public address -> (EXT+INT segments, key -> (start, end))
+        self._rest = {}     # public address -> EXT segments of everyone else
+        self._keys = None   # ordered keys, None when stale
+        self._blob = None   # all EXT segments, in key order
+        self._offs = None   # key -> (start, end) in _blob
+        self._size = None   # length of every EXT segment, if all the same
+        self._log = collections.deque() # (generation, key, sin) of changes
+        self._reseed()
+
+    def _reseed(self):
+        # 0 is what a client with no list from us says it has
+        self.generation = random.randint(1, _GEN_MOD // 2)
+        self._log.clear()
+        self._logbase = self.generation # the log is complete after this
+
+    def update(self, k, client):
+        """Encode (or re-encode) the segments for a client"""
+        sin = client.sin
+        ext = protocol.encode_address(protocol.PTP_TYPE_CLIENTLIST_EXT, sin)
+        intaddr = ''
+        if client.ptpaddr is not None:
+            intaddr = protocol.encode_address(protocol.PTP_TYPE_CLIENTLIST_INT,
+                    client.ptpaddr)
+
+        if k in self._ext:
+            if self._ext[k] == ext and self._int[k] == intaddr:
+                return # nothing changed
+            self._ungroup(k)
+
+        self._ext[k] = ext
+        self._int[k] = intaddr
+        self._sin[k] = sin
+        self._groups.setdefault(sin[0], set()).add(k)
+        self._gblob.pop(sin[0], None)
+        self._changed(k, sin)
+
+    def remove(self, k):
+        """Forget a client"""
+        if k not in self._ext:
+            return
+        self._ungroup(k)
+        sin = self._sin.pop(k)
+        del(self._ext[k])
+        del(self._int[k])
+        self._changed(k, sin)
+
+    def _changed(self, k, sin):
+        self._keys = None
+        self._rest = {}
+        if self.generation + 1 >= _GEN_MOD:
+            self._reseed()
+        self.generation += 1
+        if len(self._log) >= CHANGE_LOG_SIZE:
+            self._logbase = self._log.popleft()[0]
+        self._log.append((self.generation, k, sin))
+
+    def _ungroup(self, k):
+        ip = self._sin[k][0]
+        group = self._groups[ip]
+        group.discard(k)
+        if not group:
+            del(self._groups[ip])
+        self._gblob.pop(ip, None)
+
+    def _rebuild(self):
+        keys = self._ext.keys()
+        offs = {}
+        segs = []
+        off = 0
+        for k in keys:
+            seg = self._ext[k]
+            offs[k] = (off, off + len(seg))
+            off += len(seg)
+            segs.append(seg)
+        self._keys = keys
+        self._blob = ''.join(segs)
+        self._offs = offs
+        sizes = set(map(len, segs))
+        self._size = sizes.pop() if len(sizes) == 1 else None
+
+    def clientlist(self, k, client):
+        """Returns (count, encoded TLVs) of the client list to send to
+        client k; this is every other client, and for those that share
+        its public address their internal address too."""
+        if self._keys is None:
+            self._rebuild()
+
+        ip = client.sin[0]
+        count = len(self._keys) - (k in self._offs)
+        group = self._groups.get(ip, ())
+        if len(group) <= (k in group):
+            # Nobody else behind the same address; just cut ourself out
+            (start, end) = self._offs.get(k, (0, 0))
+            return (count, self._blob[:start] + self._blob[end:])
+
+        # Everyone else, then our neighbours with their internal address
+        (gblob, goffs) = self._group(ip)
+        (start, end) = goffs.get(k, (0, 0))
+        return (count, self._restof(ip) + gblob[:start] + gblob[end:])
+
+    def _group(self, ip):
+        """The EXT and INT segments of every client behind ip"""
+        if ip not in self._gblob:
+            offs = {}
+            segs = []
+            off = 0
+            for gk in self._groups[ip]:
+                seg = self._ext[gk] + self._int[gk]
+                offs[gk] = (off, off + len(seg))
+                off += len(seg)
+                segs.append(seg)
+            self._gblob[ip] = (''.join(segs), offs)
+        return self._gblob[ip]
+
+    def _restof(self, ip):
+        """The EXT segments of every client not behind ip"""
+        if ip not in self._rest:
+            cuts = sorted(self._offs[gk] for gk in self._groups[ip])
+            segs = []
+            off = 0
+            for (start, end) in cuts:
+                segs.append(self._blob[off:start])
+                off = end
+            segs.append(self._blob[off:])
+            self._rest[ip] = ''.join(segs)
+        return self._rest[ip]
+
+    def pages(self, k, client, size):
+        """Returns the client list for client k split into a list of
+        (count, encoded TLVs) pages of at most size bytes each. An entry
+        is never split from its CLIENTLIST_INT."""
+        (count, body) = self.clientlist(k, client)
+        if len(body) <= size:
+            return [(count, body)]
+
+        ip = client.sin[0]
+        group = self._groups.get(ip, ())
+        others = [gk for gk in group if gk != k]
+        if others:
+            rest = self._restof(ip)
+        else:
+            (start, end) = self._offs.get(k, (0, 0))
+            rest = self._blob[:start] + self._blob[end:]
+
+        pages = []
+        page = []
+        used = 0
+        if self._size is not None:
+            # Every EXT entry is the same size, so we can just slice those up
+            step = (size // self._size) * self._size
+            for i in xrange(0, len(rest), step):
+                page = [rest[i:i + step]]
+                used = len(page[0])
+                pages.append((used // self._size, page))
+            if pages:
+                pages.pop()
+            segs = [self._ext[gk] + self._int[gk] for gk in others]
+            count = used // self._size
+        else:
+            segs = [self._ext[sk] for sk in self._keys if sk not in group]
+            segs.extend(self._ext[gk] + self._int[gk] for gk in others)
+            count = 0
+
+        for seg in segs:
+            if used + len(seg) > size and page:
+                pages.append((count, page))
+                page = []
+                used = 0
+                count = 0
+            page.append(seg)
+            used += len(seg)
+            count += 1
+        if page:
+            pages.append((count, page))
+        return [(count, ''.join(page)) for (count, page) in pages]
+
+    def delta(self, k, client, base):
+        """Returns (count, encoded TLVs) of the changes to the client
+        list of client k since generation base, or None if we no longer
+        know them all and it needs the whole list instead.
+
+        Each client touched since base appears once, in its current
+        state; count is the number of those that were added or changed,
+        the remainder are CLIENTDEL entries."""
+        if base > self.generation or base < self._logbase:
+            return None
+
+        group = self._groups.get(client.sin[0], ())
+        seen = set()
+        segs = []
+        count = 0
+        for (gen, sk, sin) in reversed(self._log):
+            if gen <= base:
+                break
+            if sk == k or sk in seen:
+                continue
+            seen.add(sk)
+            if sk in self._ext:
+                segs.append(self._ext[sk])
+                if sk in group:
+                    segs.append(self._int[sk])
+                count += 1
+            else:
+                segs.append(protocol.encode_address(protocol.PTP_TYPE_CLIENTDEL, sin))
+        return (count, ''.join(segs))
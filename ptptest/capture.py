@@ -0,0 +1,207 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+# Copyright (c) 2014 Chris Luke <chrisy@flirble.org>
+#
+"""Capture of the datagrams we send and receive, to pcap files"""
+
+import os, struct, collections
+import dpkt.pcap
+from eventlet.green import socket, time
+import clock, pacing
+
+# Default size and number of capture files to keep
+CAPTURE_SIZE        = 16 * 1024 * 1024
+CAPTURE_COUNT       = 8
+
+# How often the captured datagrams are written out, in seconds
+FLUSH_INTERVAL      = 0.25
+
+# How many datagrams we hold until they are written out
+CAPTURE_RING_SIZE   = 65536
+
+# The link type in the file for bare IP; dpkt's DLT_RAW is the BSD
+# value, which is not what goes in a pcap file
+LINKTYPE_RAW        = 101
+SNAPLEN             = 65535
+
+# How many peer addresses we remember the packing and route of; the
+# lot are forgotten when there are more, and when a new file is started
+ADDR_CACHE_SIZE     = 4096
+
+_IP = struct.Struct('!BBHHHBBH4s4s')
+_UDP = struct.Struct('!HHHH')
+_WORDS = struct.Struct('!HH')
+# What the fixed fields of our IP headers add to the checksum
+_IP_SUM = 0x4500 + 0x4000 + (64 << 8) + socket.IPPROTO_UDP
+# Native order, as dpkt writes the file header in
+_PKTHDR = struct.Struct('=IIII')
+
+
+class Capture(object):
+    """Writes datagrams to a pcap file, each as an IPv4 packet with a
+    UDP header holding our address and the peer's. They are stamped to
+    the nanosecond, with the time the kernel received them if we have
+    it.
+
+    Sending and receiving only add the datagram to a ring of
+    CAPTURE_RING_SIZE records, the oldest dropped if it fills. A hub
+    timer writes out what is there every FLUSH_INTERVAL seconds, in one
+    go. A new file is started when the current one reaches size bytes
+    or, if interval is given, is that many seconds old; count old ones
+    are kept as path.1, path.2 and so on, as FileLog does.
+
+    Bound to INADDR_ANY, we have no one address of our own; each peer's
+    packets are given the one the kernel routes to it from, asked for
+    once per peer. Up to ADDR_CACHE_SIZE peers are remembered, and none
+    past the start of a new file."""
+
+    def __init__(self, path, local, size=CAPTURE_SIZE, count=CAPTURE_COUNT,
+            interval=None, events=None):
+        super(Capture, self).__init__()
+        self.path = path
+        self.size = size
+        self.count = count
+        self.interval = interval
+        self.events = events
+        self.dropped = 0
+        self._ring = collections.deque(maxlen=CAPTURE_RING_SIZE)
+        self._addrs = {}    # address -> (packed address, its checksum sum)
+        self._ours = {}     # their address -> the same, of ours to them
+        (self._bound, self._port) = local
+        if self._bound == '0.0.0.0':
+            self._bound = None
+        self._open()
+        self._flusher = pacing.Periodic(FLUSH_INTERVAL, self.flush)
+        self._flusher.start(FLUSH_INTERVAL)
+
+    def _open(self):
+        self._file = open(self.path, 'wb')
+        # nano makes the timestamps nanoseconds, which our own record
+        # headers fill in; dpkt's would go through a float
+        dpkt.pcap.Writer(self._file, snaplen=SNAPLEN, linktype=LINKTYPE_RAW, nano=True)
+        self._opened = time.time()
+
+    def _rotate(self):
+        self._file.close()
+        for n in xrange(self.count - 1, 0, -1):
+            old = "%s.%d" % (self.path, n)
+            if os.path.exists(old):
+                os.rename(old, "%s.%d" % (self.path, n + 1))
+        if self.count:
+            os.rename(self.path, self.path + ".1")
+        self._addrs.clear()
+        self._ours.clear()
+        self._open()
+
+    def sent(self, packet, sin):
+        ring = self._ring
+        if len(ring) == ring.maxlen:
+            self.dropped += 1
+        ring.append((clock.realtime_ns(), True, packet, sin))
+
+    def received(self, packets):
+        """Add what DatagramIO.recv() returned"""
+        ring = self._ring
+        excess = len(ring) + len(packets) - ring.maxlen
+        if excess > 0:
+            self.dropped += excess
+        # Those without a kernel timestamp came in no later than this
+        now = clock.realtime_ns()
+        for (buf, sin, rx) in packets:
+            ring.append((rx or now, False, buf, sin))
+
+    def _pack_addr(self, address):
+        packed = self._addrs.get(address)
+        if packed is None:
+            if len(self._addrs) >= ADDR_CACHE_SIZE:
+                self._addrs.clear()
+            raw = socket.inet_aton(address)
+            packed = self._addrs[address] = (raw, sum(_WORDS.unpack(raw)))
+        return packed
+
+    def _our_addr(self, address):
+        packed = self._ours.get(address)
+        if packed is None:
+            if len(self._ours) >= ADDR_CACHE_SIZE:
+                self._ours.clear()
+            packed = self._ours[address] = self._pack_addr(
+                    self._bound or self._route(address))
+        return packed
+
+    def _route(self, address):
+        """The address the kernel would send to address from; connecting
+        a UDP socket picks it, without sending anything"""
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.connect((address, 9))
+            return s.getsockname()[0]
+        except socket.error:
+            return '0.0.0.0'
+        finally:
+            s.close()
+
+    def _record(self, ts, out, buf, sin):
+        port = self._port
+        (ours, oursum) = self._our_addr(sin[0])
+        (theirs, theirsum) = self._pack_addr(sin[0])
+        if out:
+            (src, sport, dst, dport) = (ours, port, theirs, sin[1])
+        else:
+            (src, sport, dst, dport) = (theirs, sin[1], ours, port)
+        n = len(buf)
+        # The IP header checksum, with only the length left to add in
+        csum = _IP_SUM + oursum + theirsum + 28 + n
+        csum = (csum & 0xffff) + (csum >> 16)
+        csum = ~((csum & 0xffff) + (csum >> 16)) & 0xffff
+        (sec, nsec) = divmod(ts, 1000000000)
+        return (_PKTHDR.pack(sec, nsec, 28 + n, 28 + n) +
+                _IP.pack(0x45, 0, 28 + n, 0, 0x4000, 64, socket.IPPROTO_UDP, csum, src, dst) +
+                _UDP.pack(sport, dport, 8 + n, 0) + buf)
+
+    def flush(self):
+        """Write out what has been captured so far"""
+        ring = self._ring
+        if self.dropped and self.events is not None:
+            (dropped, self.dropped) = (self.dropped, 0)
+            self.events.warning("%d captured datagrams were dropped", dropped)
+        if ring:
+            records = []
+            while ring:
+                records.append(self._record(*ring.popleft()))
+            self._file.write(''.join(records))
+            self._file.flush()
+
+        if (self._file.tell() >= self.size or
+                (self.interval and time.time() - self._opened >= self.interval)):
+            self._rotate()
+
+    def close(self):
+        self._flusher.stop()
+        self.flush()
+        self._file.close()
+
+
+class CaptureIO(object):
+    """A DatagramIO, or MmsgIO, that hands everything it sends and
+    receives to a Capture on the way"""
+
+    def __init__(self, io, capture):
+        super(CaptureIO, self).__init__()
+        self.io = io
+        self.capture = capture
+        self.timestamps = io.timestamps
+
+    def recv(self):
+        packets = self.io.recv()
+        self.capture.received(packets)
+        return packets
+
+    def sendto(self, packet, sin):
+        self.capture.sent(packet, sin)
+        self.io.sendto(packet, sin)
+
+    def flush(self):
+        self.io.flush()
+
+    def batch(self):
+        return self.io.batch()
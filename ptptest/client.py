@@ -4,28 +4,50 @@
 # 
 """PTP Client"""
 
-import sys, uuid, copy
+import sys, uuid, random, collections, json
 if sys.platform == 'win32':
     import win32hacks
     win32hacks.install_hacks()
 
-import eventlet, eventlet.debug
+import eventlet, eventlet.debug, eventlet.event, eventlet.hubs, eventlet.queue
 
 # Don't patch 'os' because it breaks nonblocking os.read
 eventlet.monkey_patch(socket=True, os=False, time=True)
 eventlet.debug.hub_prevent_multiple_readers(False)
-eventlet.debug.hub_blocking_detection(True)
 
 from eventlet.green import socket
 from eventlet.green import time
 
 import __init__ as ptptest
-import protocol, hexdump, ui
+import protocol, hexdump, events, mmsg, peer, pacing, clock, capture
+import bson_wrapper, bson
 
-PTP_CLIENTVER       = 2
+PTP_CLIENTVER       = 5
 
-def _mkey(addr, port):
-    return "%s-%d" % (addr, port)
+# Servers from this version on understand CLIENTGEN, META in BSON, and
+# our times in the answers to their timestamps; clients from this one on
+# the latter
+PTP_GEN_SERVERVER   = 4
+PTP_BSON_SERVERVER  = 5
+PTP_NTP_SERVERVER   = 6
+PTP_NTP_CLIENTVER   = 5
+
+_CLIENTVER_TLV = protocol.encode_uint(protocol.PTP_TYPE_CLIENTVER, 1, PTP_CLIENTVER)
+
+# Seconds between our beacons to the servers, and to the other clients
+SERVER_INTERVAL     = 7
+CLIENT_INTERVAL     = 0.5
+
+# Each beacon to a client is up to this fraction of CLIENT_INTERVAL
+# early or late, so that they don't fall into step
+CLIENT_JITTER       = 0.1
+
+# Default ceiling on beacon packets per second to the other clients
+CLIENT_PPS          = 200
+
+# Most pages of a client list we take from a server; at 80 or more
+# entries a page that is more peers than we could ever beacon
+CLIENT_MAX_PAGES    = 1024
 
 
 class Client(object):
@@ -37,7 +59,7 @@ class Client(object):
 
     servers = {}
     clients = {}
-    server_seq = 0
+    events = None
     ui = None
     stun = None
 
@@ -47,6 +69,11 @@ class Client(object):
     def __init__(self, args):
         super(Client, self).__init__()
         self.args = args
+        if getattr(args, 'hub', None):
+            # Before anything is waiting on the hub we'd be replacing
+            eventlet.hubs.use_hub(args.hub)
+        self.events = events.Events(level=events.DEBUG if args.debug else events.INFO,
+                sample=getattr(args, 'debugsample', 1))
 
         if 'stun' in args and args.stun:
             import stunloop
@@ -66,6 +93,9 @@ class Client(object):
         s.bind(('0.0.0.0', 0))
         self.port = s.getsockname()[1]
         self.sock = s
+        self.io = mmsg.datagram_io(s, protocol.PTP_MTU, batched=getattr(args, 'mmsg', True),
+                timestamps=getattr(args, 'kernelts', False), events=self.events)
+        self._capture = None
 
         # Resolve the server name
         addrs = socket.getaddrinfo(args.server, int(args.port),
@@ -76,336 +106,593 @@ class Client(object):
         sin = addrs[0][4]
         hostname = addrs[0][3]
 
-        sk = _mkey(sin[0], sin[1])
         self.servers = {
-                sk: {
-                    'sin': sin,
-                    'name': hostname,
-                    'ts': time.time(),
-                    'stats': {
-                        'sent': 0,
-                        'rcvd': 0,
-                        'ackd': 0,
-                        'rtt': 0,
-                    },
-                },
+                sin: peer.Peer(sin, name=hostname, ts=time.time()),
         }
         self.clients = {}
-
-    def _server_parse(self, buf, sin, server):
-        l = protocol.PTP(buf)
-        if l is None:
-            self.ui.log("Server packet from %s failed to parse!" % repr(sin))
+        self._pages = {}
+        self._via = {}  # external address -> the address we use
+        self._gen = 0   # generation of our client list
+        self._stopped = eventlet.event.Event()
+        self._uuid_tlv = protocol.encode_string(protocol.PTP_TYPE_UUID, self.uuid)
+        self._meta_split = False  # servers are each told only of themselves
+        self._meta_unfit = set()  # servers even their own META is too big for
+
+        pps = CLIENT_PPS
+        if 'pps' in args and args.pps:
+            pps = args.pps
+        self._pacer = pacing.TokenBucket(pps)
+        self._schedule = pacing.Schedule()
+        self._wakeup = eventlet.queue.LightQueue()
+        self._kicked = False
+
+    def _server_parse(self, buf, sin, server, rx=None, trace=False):
+        (now, rx_mono) = (clock.realtime_ns(), clock.monotonic_ns())
+        if rx is None:
+            rx = now
+        else:
+            # Then it arrived this much earlier by the monotonic clock too
+            delay = max(0, now - rx)
+            rx_mono -= delay
+            server.add_rx_delay(delay / 1e9)
+        try:
+            l = protocol.decode(buf)
+        except protocol.ChecksumError:
+            self.events.warning("Server packet from %r has a bad checksum!", sin)
             return False
-        if l.buf_csum is None or l.buf_csum != l.csum:
-            self.ui.log("Server packet from %s has a bad checksum!" % repr(sin))
+        except protocol.DecodeError, e:
+            self.events.warning("Server packet from %r failed to parse! %s", sin, e)
             return False
 
-        server['ts'] = time.time()
-        server['stats']['rcvd'] += 1
+        server.ts = rx / 1e9
+        server.rcvd += 1
 
-        if self.args.debug: self.ui.log(repr(l))
+        if trace:
+            self.events.debug("%r", events.Lazy(protocol.PTP, buf))
 
         new_clients = []
+        via = {}
+        removed = []
         num_clients = None
-
-        for tlv in l.data:
-            p = tlv.data
-            if p.ptp_type == protocol.PTP_TYPE_SERVERVER:
-                server['serverver'] = p.data
-            elif p.ptp_type == protocol.PTP_TYPE_SEQUENCE:
-                server['sequence'] = p.data
-            elif p.ptp_type == protocol.PTP_TYPE_UUID:
-                server['uuid'] = p.data
-            elif p.ptp_type == protocol.PTP_TYPE_MYTS:
-                self._server_respond(server, p.data)
-                server['myts'] = float(p.data) / float(2**32)
-            elif p.ptp_type == protocol.PTP_TYPE_YOURTS:
-                ts = float(p.data) / float(2**32)
-                rtt = server['ts'] - ts
-                server['stats']['rtt'] = rtt
-                server['stats']['ackd'] += 1
-                self.ui.log("ACK from server %s; RTT %fs" % (str(sin), rtt))
-            elif p.ptp_type == protocol.PTP_TYPE_CLIENTLEN:
-                num_clients = p.data
-            elif p.ptp_type == protocol.PTP_TYPE_CLIENTLIST_EXT:
-                new_clients.append(p.data) # should be a sockaddr
-            elif p.ptp_type == protocol.PTP_TYPE_CLIENTLIST_INT:
+        gen = base = page = pages = None
+        their_ts = your_ts = rxts = txts = None
+
+        for (ptp_type, data) in l:
+            if ptp_type == protocol.PTP_TYPE_SERVERVER:
+                if data != server.serverver:
+                    server.serverver = data
+                    # what goes in these depends on it
+                    server.echo = None
+                    server.beacon = None
+            elif ptp_type == protocol.PTP_TYPE_SEQUENCE:
+                server.sequence = data
+                server.seen(data)
+            elif ptp_type == protocol.PTP_TYPE_UUID:
+                if data != server.uuid:
+                    server.uuid = data
+                    server.echo = None # it has their UUID in
+            elif ptp_type == protocol.PTP_TYPE_MYTS:
+                their_ts = data
+            elif ptp_type == protocol.PTP_TYPE_YOURTS:
+                your_ts = data
+            elif ptp_type == protocol.PTP_TYPE_RXTS:
+                rxts = data
+            elif ptp_type == protocol.PTP_TYPE_TXTS:
+                txts = data
+            elif ptp_type == protocol.PTP_TYPE_CLIENTLEN:
+                num_clients = data
+            elif ptp_type == protocol.PTP_TYPE_CLIENTGEN:
+                gen = data
+            elif ptp_type == protocol.PTP_TYPE_CLIENTPAGE:
+                page = data
+            elif ptp_type == protocol.PTP_TYPE_CLIENTPAGES:
+                pages = data
+            elif ptp_type == protocol.PTP_TYPE_CLIENTBASE:
+                base = data
+            elif ptp_type == protocol.PTP_TYPE_CLIENTLIST_EXT:
+                new_clients.append(data) # should be a sockaddr
+            elif ptp_type == protocol.PTP_TYPE_CLIENTLIST_INT:
                 # server thinks the previous address may be on the same
                 # network as us, so has sent us a clients internal address
-                # This is crude, but we just overwrite the previous address for now
-                new_clients[-1] = p.data
-            elif p.ptp_type == protocol.PTP_TYPE_YOURADDR:
-                self.ui.log("Server sees us as %s" % repr(p.data))
-                self.ui.set_address(p.data[0], p.data[1])
-
-        self.ui.peer_update('server', server['sin'], server['stats'])
+                # This is crude, but we just use it instead of the previous one
+                via[new_clients[-1]] = data
+            elif ptp_type == protocol.PTP_TYPE_CLIENTDEL:
+                removed.append(data)
+            elif ptp_type == protocol.PTP_TYPE_YOURADDR:
+                self.events.log("Server sees us as %r", data)
+                self.events.set_address(data[0], data[1])
+
+        if their_ts is not None:
+            self._server_respond(server, their_ts, rx)
+        if your_ts is not None:
+            rtt = server.add_exchange(your_ts, rx_mono, rx, rxts, txts)
+            server.ackd += 1
+            self.events.log("ACK from server %s; RTT %fs", sin, rtt)
+
+        self.events.peer_update('server', server)
 
         if num_clients is not None:
-            if num_clients == len(new_clients):
-                with self._clock:
-                    # Sync the client list
-                    delete = []
-                    for k in self.clients:
-                        if not self.clients[k]['sin'] in new_clients: # old
-                            delete.append(k)
-                    for k in delete:
-                        if self.args.debug: self.ui.log("Removing old client %s" % str(self.clients[k]['sin']))
-                        self.ui.peer_del(group='client', sin=self.clients[k]['sin'])
-                        del(self.clients[k])
-                    for sin in new_clients:
-                        k = _mkey(sin[0], sin[1])
-                        if k not in self.clients: # new
-                            if self.args.debug: self.ui.log("Adding new client %s" % str(sin))
-                            self.clients[k] = {
-                                'sin': sin,
-                                'ts': time.time(),
-                                'myseq': 0L,
-                                'stats': {
-                                    'sent': 0,
-                                    'rcvd': 0,
-                                    'ackd': 0,
-                                    'rtt': 0,
-                                },
-                            }
-                            self.ui.peer_add(group='client', sin=sin)
-                    if self.args.debug: self.ui.log("Client count: %d" % len(self.clients))
+            if num_clients != len(new_clients):
+                self.events.warning("Mismatch in client list from server")
+            elif base is not None:
+                self._apply_delta(base, gen, new_clients, via, removed)
             else:
-                self.ui.log("Mismatch in client list from server")
+                if pages is not None:
+                    paged = self._server_page(sin, gen, page, pages, (new_clients, via))
+                    if paged is None:
+                        return True
+                    (new_clients, via) = paged
+                self._sync_clients(new_clients, via)
+                self._gen = gen or 0
 
         return True
 
-    def _server_respond(self, server, their_ts):
-        l = protocol.PTP(data=[])
-        l.data = []
-        t = protocol.TLV(type=protocol.PTP_TYPE_CLIENTVER, data=protocol.UInt(size=1, data=PTP_CLIENTVER))
-        l.data.append(t)
-        t = protocol.TLV(type=protocol.PTP_TYPE_SEQUENCE, data=protocol.UInt(size=4, data=self.server_seq))
-        l.data.append(t)
-        t = protocol.TLV(type=protocol.PTP_TYPE_UUID, data=protocol.String(data=server['uuid']))
-        l.data.append(t)
-        t = protocol.TLV(type=protocol.PTP_TYPE_YOURTS, data=protocol.UInt(size=8, data=their_ts))
-        l.data.append(t)
-
-        packet = l.pack()
-        if len(packet) > protocol.PTP_MTU: # bad
-            self.ui.log("Ignoring attempt to send ts %d bytes to server %s. MTU is %d" % \
-                    (len(packet), str(server['sin']), protocol.PTP_MTU))
+    def _server_page(self, sin, gen, page, pages, new_clients):
+        """Collect one page of a paginated client list. Returns the
+        whole list once every page of one generation has arrived."""
+        if (gen is None or page is None or not 0 < pages <= CLIENT_MAX_PAGES or
+                page >= pages):
+            self.events.warning("Ignoring client list page %r of %r, generation %r, from %r",
+                    page, pages, gen, sin)
+            return None
+
+        p = self._pages.get(sin)
+        if p is None or p['gen'] != gen or p['pages'] != pages:
+            # A new list; anything we had of an older one is useless
+            p = self._pages[sin] = {
+                'gen': gen,
+                'pages': pages,
+                'lists': {},
+            }
+        p['lists'][page] = new_clients
+        self.events.debug("Client list generation %d page %d of %d",
+                gen, page + 1, pages)
+
+        if len(p['lists']) < pages:
+            return None
+
+        del(self._pages[sin])
+        new_clients = []
+        via = {}
+        for index in xrange(pages):
+            (l, v) = p['lists'][index]
+            new_clients.extend(l)
+            via.update(v)
+        return (new_clients, via)
+
+    def _apply_delta(self, base, gen, added, via, removed):
+        """Apply the changes since generation base to our client list.
+        If our list is not from somewhere between base and gen then the
+        delta is no use; we tell the server we need the whole list."""
+        if gen is None:
+            self.events.warning("Ignoring client list delta from %d without a generation", base)
+            return
+        if not self._gen or not base <= self._gen <= gen:
+            if self._gen:
+                self.events.log("Client list delta %d-%d does not apply to %d",
+                        base, gen, self._gen)
+                self._gen = 0
+                eventlet.spawn(self._server_beacons)
             return
 
-        if self.args.debug:
-            self.ui.log("Sending ts %d bytes to server %s" % (len(packet), str(server['sin'])))
-            self.ui.log("%s" % repr(protocol.PTP(packet)), indent='  ')
-            if self.args.hexdump:
-                self.ui.log(hexdump.hexdump(result='return', data=packet))
+        with self._clock:
+            for sin in removed:
+                self._client_del(sin)
+            for sin in added:
+                self._client_add(sin, via.get(sin, sin))
+        self._gen = gen
+        self.events.debug("Client count: %d", len(self.clients))
+
+    def _sync_clients(self, new_clients, via):
+        with self._clock:
+            # Sync the client list
+            wanted = dict((sin, via.get(sin, sin)) for sin in new_clients)
+            for sin in self._via.keys():
+                if self._via[sin] != wanted.get(sin): # old
+                    self._client_del(sin)
+            for sin in new_clients:
+                self._client_add(sin, wanted[sin])
+        self.events.debug("Client count: %d", len(self.clients))
+
+    def _client_add(self, ext, sin):
+        """Add a client, known to the server as ext, that we talk to at sin"""
+        old = self._via.get(ext)
+        if old == sin:
+            return
+        if old is not None:
+            self._client_del(ext)
+        self._via[ext] = sin
+
+        if sin not in self.clients: # new
+            self.events.debug("Adding new client %s", sin)
+            self.clients[sin] = peer.Peer(sin, ts=time.time())
+            self.events.peer_add('client', self.clients[sin])
+            # Start it at a random point in the interval
+            self._schedule.schedule(sin, time.time() + random.random() * CLIENT_INTERVAL)
+            self._kick()
+
+    def _client_del(self, ext):
+        """Remove a client known to the server as ext"""
+        sin = self._via.pop(ext, None)
+        if sin is None:
+            return
 
-        self.sock.sendto(packet, server['sin'])
-        self.server_seq += 1L
+        if sin in self.clients: # old
+            self.events.debug("Removing old client %s", sin)
+            self.events.peer_del('client', self.clients[sin])
+            self._schedule.cancel(sin)
+            del(self.clients[sin])
+
+    def _server_respond(self, server, their_ts, rx):
+        """Answer a server's timestamp, with when we got it (rx) and,
+        if it understands them, when we answered, by our realtime clock"""
+        ntp = server.serverver >= PTP_NTP_SERVERVER
+        if server.echo is None:
+            server.echo = self._echo_template(ntp,
+                    protocol.encode_string(protocol.PTP_TYPE_UUID, server.uuid or ''))
+        server.echo.set('seq', server.myseq)
+        server.echo.set('ts', their_ts)
+        if ntp:
+            server.echo.set('rx', rx)
+            server.echo.set('tx', clock.realtime_ns())
+        packet = server.echo.packet()
+
+        if self.events.sampled(events.DEBUG):
+            self.events.debug("Sending ts %d bytes to server %s", len(packet), server.sin)
+            self.events.debug("%r", events.Lazy(protocol.PTP, packet), indent='  ')
+            if self.args.hexdump:
+                self.events.debug("%s", events.Lazy(hexdump.hexdump, packet, 'return'))
+
+        self.io.sendto(packet, server.sin)
+        server.myseq += 1
+
+    def _echo_template(self, ntp, uuid_tlv):
+        parts = [
+            _CLIENTVER_TLV,
+            ('seq', protocol.PTP_TYPE_SEQUENCE, 4),
+            uuid_tlv,
+            ('ts', protocol.PTP_TYPE_YOURTS, 8),
+        ]
+        if ntp:
+            parts += [('rx', protocol.PTP_TYPE_RXTS, 8), ('tx', protocol.PTP_TYPE_TXTS, 8)]
+        return protocol.Template(*parts)
 
     def _server_beacons(self, shutdown=False):
-        # Tell the server about ourself
-        l = protocol.PTP(data=[])
-        l.data = []
-
-        t = protocol.TLV(type=protocol.PTP_TYPE_CLIENTVER, data=protocol.UInt(size=1, data=PTP_CLIENTVER))
-        l.data.append(t)
-        t = protocol.TLV(type=protocol.PTP_TYPE_SEQUENCE, data=protocol.UInt(size=4, data=self.server_seq))
-        l.data.append(t)
-        t = protocol.TLV(type=protocol.PTP_TYPE_UUID, data=protocol.String(data=self.uuid))
-        l.data.append(t)
-        t = protocol.TLV(type=protocol.PTP_TYPE_PTPADDR, data=protocol.Address(data=(self.addr, self.port)))
-        l.data.append(t)
+        # Tell the servers about ourself
+        meta = self._meta_tlv()
+        with self._slock:
+            for server in self.servers.values():
+                self._server_beacon(server, meta or self._server_meta(server), shutdown)
+
+    def _server_beacon(self, server, meta, shutdown):
+        # Older servers don't know CLIENTGEN, and give up on the packet
+        gen = server.serverver >= PTP_GEN_SERVERVER
         if shutdown:
-            t = protocol.TLV(type=protocol.PTP_TYPE_SHUTDOWN, data=protocol.UInt(size=1, data=1))
-            l.data.append(t)
+            # Only sent the once, so not worth a template
+            parts = [
+                _CLIENTVER_TLV,
+                protocol.encode_uint(protocol.PTP_TYPE_SEQUENCE, 4, server.myseq),
+                self._uuid_tlv,
+                protocol.encode_address(protocol.PTP_TYPE_PTPADDR, (self.addr, self.port)),
+            ]
+            if gen:
+                parts.append(protocol.encode_uint(protocol.PTP_TYPE_CLIENTGEN, 4, self._gen))
+            parts += [protocol.encode_uint(protocol.PTP_TYPE_SHUTDOWN, 1, 1), meta]
+            packet = protocol.encode(''.join(parts))
         else:
-            t = protocol.TLV(type=protocol.PTP_TYPE_MYTS,
-                    data=protocol.UInt(size=8, data=int(time.time()*2**32)))
-            l.data.append(t)
-
-        tmp = copy.deepcopy(self.servers)
-        for k in tmp:
-            if 'uuid' in tmp[k]:
-                del(tmp[k]['uuid'])
-        t = protocol.TLV(type=protocol.PTP_TYPE_META, data=protocol.JSON(data=tmp))
-        l.data.append(t)
-
-        packet = l.pack()
+            if server.beacon is None:
+                parts = [
+                    _CLIENTVER_TLV,
+                    ('seq', protocol.PTP_TYPE_SEQUENCE, 4),
+                    self._uuid_tlv,
+                    protocol.encode_address(protocol.PTP_TYPE_PTPADDR, (self.addr, self.port)),
+                ]
+                if gen:
+                    parts.append(('gen', protocol.PTP_TYPE_CLIENTGEN, 4))
+                parts.append(('ts', protocol.PTP_TYPE_MYTS, 8))
+                server.beacon = protocol.Template(*parts)
+            server.beacon.set('seq', server.myseq)
+            if gen:
+                server.beacon.set('gen', self._gen)
+            server.beacon.set('ts', clock.monotonic_ns())
+            packet = server.beacon.packet(meta)
+
         if len(packet) > protocol.PTP_MTU: # bad
-            self.ui.log("Ignoring attempt to send %d bytes to servers. MTU is %d" % (len(packet), protocol.PTP_MTU))
+            self.events.warning("Ignoring attempt to send %d bytes to server %s. MTU is %d",
+                    len(packet), server.sin, protocol.PTP_MTU)
             return
 
-        if self.args.debug:
-            self.ui.log("Sending %d bytes to servers:" % len(packet))
-            self.ui.log("%s" % repr(protocol.PTP(packet)), indent='  ')
+        if self.events.sampled(events.DEBUG):
+            self.events.debug("Sending %d bytes to server %s", len(packet), server.sin)
+            self.events.debug("%r", events.Lazy(protocol.PTP, packet), indent='  ')
             if self.args.hexdump:
-                self.ui.log(hexdump.hexdump(result='return', data=packet))
-
-        with self._slock:
-            for k in self.servers:
-                server = self.servers[k]
-                server['stats']['sent'] += 1
-                self.sock.sendto(packet, server['sin'])
-                self.ui.peer_update('server', server['sin'], server['stats'])
-
-        self.server_seq += 1L
-
-    def _client_parse(self, buf, sin, client):
-        l = protocol.PTP(buf)
-        if l is None:
-            self.ui.log("Client packet from %s failed to parse!" % repr(sin))
+                self.events.debug("%s", events.Lazy(hexdump.hexdump, packet, 'return'))
+
+        self.io.sendto(packet, server.sin)
+        server.sent += 1
+        server.myseq += 1
+        self.events.peer_update('server', server)
+
+    def _meta_tlv(self):
+        """The META TLV for our server beacons, telling each of them all
+        of them, or '' if that does not fit in a TLV. Their times and
+        counters change between most beacons, so this is encoded afresh
+        each time"""
+        tlv = self._encode_meta(self.servers.values())
+        # Said once, not at every beacon until it fits again
+        if (tlv == '') != self._meta_split:
+            self._meta_split = not self._meta_split
+            if self._meta_split:
+                self.events.log("META for %d servers is more than a TLV holds; "
+                        "each is told of itself alone", len(self.servers))
+        return tlv
+
+    def _server_meta(self, server):
+        """The META TLV telling a server of itself alone, or '' if even
+        that does not fit"""
+        tlv = self._encode_meta([server])
+        if tlv == '':
+            if server.sin not in self._meta_unfit:
+                self._meta_unfit.add(server.sin)
+                self.events.warning("Leaving META out of beacons to %s: "
+                        "more than a TLV holds", server.name)
+        else:
+            self._meta_unfit.discard(server.sin)
+        return tlv
+
+    def _encode_meta(self, servers):
+        """A META TLV telling of these servers, or '' if it would not
+        fit in one"""
+        tmp = dict(("%s-%d" % s.sin, s.meta()) for s in servers)
+        if (getattr(self.args, 'bson', False) and
+                all(s.serverver >= PTP_BSON_SERVERVER for s in servers)):
+            (ptp_type, data) = (protocol.PTP_TYPE_META_BSON, bson.dumps(tmp))
+        else:
+            (ptp_type, data) = (protocol.PTP_TYPE_META,
+                    json.dumps(tmp, separators=(',', ':')))
+        if len(data) > protocol.PTP_TLV_MAX:
+            return ''
+        return protocol.encode_string(ptp_type, data)
+
+    def _client_parse(self, buf, sin, client, rx=None, trace=False):
+        (now, rx_mono) = (clock.realtime_ns(), clock.monotonic_ns())
+        if rx is None:
+            rx = now
+        else:
+            # Then it arrived this much earlier by the monotonic clock too
+            delay = max(0, now - rx)
+            rx_mono -= delay
+            client.add_rx_delay(delay / 1e9)
+        try:
+            l = protocol.decode(buf)
+        except protocol.ChecksumError:
+            self.events.warning("Client packet from %r has a bad checksum!", sin)
             return False
-        if l.buf_csum is None or l.buf_csum != l.csum:
-            self.ui.log("Client packet from %s has a bad checksum!" % repr(sin))
+        except protocol.DecodeError, e:
+            self.events.warning("Client packet from %r failed to parse! %s", sin, e)
             return False
 
-        client['ts'] = time.time()
-        client['stats']['rcvd'] += 1
-
-        if self.args.debug: self.ui.log(repr(l))
-
-        for tlv in l.data:
-            p = tlv.data
-            if p.ptp_type == protocol.PTP_TYPE_CLIENTVER:
-                client['clientver'] = p.data
-            elif p.ptp_type == protocol.PTP_TYPE_SEQUENCE:
-                client['sequence'] = p.data
-            elif p.ptp_type == protocol.PTP_TYPE_UUID:
-                client['uuid'] = p.data
-            elif p.ptp_type == protocol.PTP_TYPE_MYTS:
-                self._client_respond(client, p.data)
-                client['myts'] = float(p.data) / float(2**32)
-            elif p.ptp_type == protocol.PTP_TYPE_YOURTS:
-                ts = float(p.data) / float(2**32)
-                rtt = client['ts'] - ts
-                client['stats']['rtt'] = rtt
-                client['stats']['ackd'] += 1
-                self.ui.log("ACK from client %s; RTT %fs" % (str(sin), rtt))
-
-        self.ui.peer_update('client', client['sin'], client['stats'])
+        client.ts = rx / 1e9
+        client.rcvd += 1
+
+        if trace:
+            self.events.debug("%r", events.Lazy(protocol.PTP, buf))
+
+        their_ts = your_ts = rxts = txts = None
+        for (ptp_type, data) in l:
+            if ptp_type == protocol.PTP_TYPE_CLIENTVER:
+                if data != client.clientver:
+                    client.clientver = data
+                    client.echo = None # what goes in depends on it
+            elif ptp_type == protocol.PTP_TYPE_SEQUENCE:
+                client.sequence = data
+                client.seen(data)
+            elif ptp_type == protocol.PTP_TYPE_UUID:
+                client.uuid = data
+            elif ptp_type == protocol.PTP_TYPE_MYTS:
+                their_ts = data
+            elif ptp_type == protocol.PTP_TYPE_YOURTS:
+                your_ts = data
+            elif ptp_type == protocol.PTP_TYPE_RXTS:
+                rxts = data
+            elif ptp_type == protocol.PTP_TYPE_TXTS:
+                txts = data
+
+        if their_ts is not None:
+            self._client_respond(client, their_ts, rx)
+        if your_ts is not None:
+            rtt = client.add_exchange(your_ts, rx_mono, rx, rxts, txts)
+            client.ackd += 1
+            self.events.log("ACK from client %s; RTT %fs", sin, rtt)
+
+        self.events.peer_update('client', client)
         return True
 
-    def _client_respond(self, client, their_ts):
-        if not 'myseq' in client or not 'sin' in client: return
-        l = protocol.PTP(data=[])
-        l.data = []
-        t = protocol.TLV(type=protocol.PTP_TYPE_CLIENTVER, data=protocol.UInt(size=1, data=PTP_CLIENTVER))
-        l.data.append(t)
-        t = protocol.TLV(type=protocol.PTP_TYPE_SEQUENCE, data=protocol.UInt(size=4, data=client['myseq']))
-        l.data.append(t)
-        t = protocol.TLV(type=protocol.PTP_TYPE_UUID, data=protocol.String(data=self.uuid))
-        l.data.append(t)
-        t = protocol.TLV(type=protocol.PTP_TYPE_YOURTS, data=protocol.UInt(size=8, data=their_ts))
-        l.data.append(t)
-
-        packet = l.pack()
-        if len(packet) > protocol.PTP_MTU: # bad
-            self.ui.log("Ignoring attempt to send ts %d bytes to client %s. MTU is %d" % \
-                    (len(packet), str(client['sin']), protocol.PTP_MTU))
-            return
-
-        if self.args.debug:
-            self.ui.log("Sending ts %d bytes to client %s" % (len(packet), str(client['sin'])))
-            self.ui.log("%s" % repr(protocol.PTP(packet)), indent='  ')
+    def _client_respond(self, client, their_ts, rx):
+        ntp = client.clientver >= PTP_NTP_CLIENTVER
+        if client.echo is None:
+            client.echo = self._echo_template(ntp, self._uuid_tlv)
+        client.echo.set('seq', client.myseq)
+        client.echo.set('ts', their_ts)
+        if ntp:
+            client.echo.set('rx', rx)
+            client.echo.set('tx', clock.realtime_ns())
+        packet = client.echo.packet()
+
+        if self.events.sampled(events.DEBUG):
+            self.events.debug("Sending ts %d bytes to client %s", len(packet), client.sin)
+            self.events.debug("%r", events.Lazy(protocol.PTP, packet), indent='  ')
+            if self.args.hexdump:
+                self.events.debug("%s", events.Lazy(hexdump.hexdump, packet, 'return'))
+
+        self.io.sendto(packet, client.sin)
+        client.myseq += 1
+
+    def _client_beacon(self, client):
+        if client.beacon is None:
+            client.beacon = protocol.Template(
+                _CLIENTVER_TLV,
+                ('seq', protocol.PTP_TYPE_SEQUENCE, 4),
+                self._uuid_tlv,
+                ('ts', protocol.PTP_TYPE_MYTS, 8))
+        client.beacon.set('seq', client.myseq)
+        client.beacon.set('ts', clock.monotonic_ns())
+        packet = client.beacon.packet()
+
+        if self.events.sampled(events.DEBUG):
+            self.events.debug("Sending ts %d bytes to client %s", len(packet), client.sin)
+            self.events.debug("%r", events.Lazy(protocol.PTP, packet), indent='  ')
             if self.args.hexdump:
-                self.ui.log(hexdump.hexdump(result='return', data=packet))
+                self.events.debug("%s", events.Lazy(hexdump.hexdump, packet, 'return'))
 
-        self.sock.sendto(packet, client['sin'])
-        client['myseq'] += 1
+        self.io.sendto(packet, client.sin)
+        client.sent += 1
+        client.myseq += 1
+        self.events.peer_update('client', client)
 
-    def _client_beacons(self):
-        with self._clock:
-            for k in self.clients:
-                client = self.clients[k]
-                if not 'myseq' in client or not 'sin' in client: continue
-                if 'uuid' in client and client['uuid'] == self.uuid: continue # self!
-
-                l = protocol.PTP(data=[])
-                l.data = []
-
-                t = protocol.TLV(type=protocol.PTP_TYPE_CLIENTVER, data=protocol.UInt(size=1, data=PTP_CLIENTVER))
-                l.data.append(t)
-                t = protocol.TLV(type=protocol.PTP_TYPE_SEQUENCE, data=protocol.UInt(size=4, data=client['myseq']))
-                l.data.append(t)
-                t = protocol.TLV(type=protocol.PTP_TYPE_UUID, data=protocol.String(data=self.uuid))
-                l.data.append(t)
-                t = protocol.TLV(type=protocol.PTP_TYPE_MYTS, data=protocol.UInt(size=8, data=int(time.time()*2**32)))
-                l.data.append(t)
-
-                packet = l.pack()
-                if len(packet) > protocol.PTP_MTU: # bad
-                    self.ui.log("Ignoring attempt to send ts %d bytes to client %s. MTU is %d" % \
-                            (len(packet), str(client['sin']), protocol.PTP_MTU))
-                    return
-
-                if self.args.debug:
-                    self.ui.log("Sending ts %d bytes to client %s" % (len(packet), str(client['sin'])))
-                    self.ui.log("%s" % repr(protocol.PTP(packet)), indent='  ')
-                    if self.args.hexdump:
-                        self.ui.log(hexdump.hexdump(result='return', data=packet))
-
-                self.sock.sendto(packet, client['sin'])
-                client['stats']['sent'] += 1
-                client['myseq'] += 1
-                self.ui.peer_update('client', client['sin'], client['stats'])
+    def _kick(self):
+        """Wake the beacon loop, to look at the schedule again"""
+        if not self._kicked:
+            self._kicked = True
+            self._wakeup.put(None)
+
+    def _beacon_loop(self):
+        """Sends each client its beacon when its deadline comes round,
+        with some jitter, no faster than the pacer allows."""
+        queue = collections.deque()
+        queued = set()
+
+        while self.running:
+            now = time.time()
+            with self._clock:
+                for (k, deadline) in self._schedule.expire(now):
+                    if k not in self.clients:
+                        continue
+                    jitter = random.uniform(-CLIENT_JITTER, CLIENT_JITTER)
+                    self._schedule.schedule(k,
+                            max(deadline + CLIENT_INTERVAL * (1 + jitter), now))
+                    if k not in queued:
+                        queued.add(k)
+                        queue.append(k)
+
+            if queue:
+                timeout = self._pacer.delay()
+                if timeout <= 0:
+                    # Send as many as we're allowed in one go
+                    with self.io.batch():
+                        while queue and self._pacer.delay() <= 0:
+                            k = queue.popleft()
+                            queued.discard(k)
+                            with self._clock:
+                                client = self.clients.get(k)
+                                if client is None or client.uuid == self.uuid:
+                                    continue # gone, or self!
+                                self._client_beacon(client)
+                                self._pacer.consume()
+                    eventlet.sleep(0)
+                    continue
+            else:
+                timeout = self._schedule.next()
+                if timeout is not None:
+                    timeout = max(0, timeout - now)
+
+            try:
+                self._wakeup.get(timeout=timeout)
+                self._kicked = False
+            except eventlet.queue.Empty:
+                pass
 
     def _read_loop(self):
         while self.running:
-            (buf, sin) = self.sock.recvfrom(protocol.PTP_MTU)
-            if self.args.debug: self.ui.log("%d bytes received from %s:%d" % (len(buf), sin[0], sin[1]))
-            k = _mkey(sin[0], sin[1])
-
-            # See if it was the server
-            with self._slock:
-                if k in self.servers:
-                    self._server_parse(buf, sin, self.servers[k])
-                else:
-                    # Client we know about?
-                    with self._clock:
-                        if k in self.clients:
-                            if self.args.debug: self.ui.log("Known client")
-                            self._client_parse(buf, sin, self.clients[k])
-                        else:
-                            if self.args.debug: self.ui.log("Unknown client")
+            packets = self.io.recv()
+            with self.io.batch():
+                for (buf, sin, rx) in packets:
+                    self._read(buf, sin, rx)
+            # Let others run, even when there's always more to read
+            eventlet.sleep(0)
+
+    def _read(self, buf, sin, rx=None):
+        # Debugging output for this packet, or not, all of it
+        trace = self.events.sampled(events.DEBUG)
+        if trace:
+            self.events.debug("%d bytes received from %s:%d", len(buf), sin[0], sin[1])
+        k = sin
+
+        # See if it was the server
+        with self._slock:
+            if k in self.servers:
+                self._server_parse(buf, sin, self.servers[k], rx, trace)
+            else:
+                # Client we know about?
+                with self._clock:
+                    if k in self.clients:
+                        if trace:
+                            self.events.debug("Known client")
+                        self._client_parse(buf, sin, self.clients[k], rx, trace)
+                    elif trace:
+                        self.events.debug("Unknown client")
 
     def run(self):
-        # Get ourselves a UI
-        self.ui = ui.UI(client=True, parent=self, force_curses=self.args.curses,
-            log_lines=self.args.log_lines)
+        if getattr(self.args, 'blockcheck', False):
+            eventlet.debug.hub_blocking_detection(True)
 
-        self.ui.title("PTP Client version %s (protocol version %d)" %
+        if getattr(self.args, 'headless', False):
+            self.events.subscribe(events.Printer())
+            events.handle_signals(self)
+        else:
+            # Get ourselves a UI
+            import ui
+            self.ui = ui.UI(client=True, parent=self, force_curses=self.args.curses,
+                log_lines=self.args.log_lines, fps=getattr(self.args, 'fps', None))
+            self.events.subscribe(self.ui)
+        if getattr(self.args, 'logfile', None):
+            self.events.subscribe(events.FileLog(self.args.logfile))
+        if getattr(self.args, 'capture', None):
+            self._start_capture(self.args.capture)
+
+        self.events.title("PTP Client version %s (protocol version %d)" %
             (ptptest.__version__, PTP_CLIENTVER), stdout=True)
-        self.ui.log("Our socket is %s %s" % (self.addr, self.port), stdout=True)
+        self.events.log("Our socket is %s %s", self.addr, self.port, stdout=True)
+        if getattr(self.args, 'kernelts', False) and not self.io.timestamps:
+            self.events.warning("Kernel timestamps need recvmmsg, which we aren't using")
 
         eventlet.spawn(self._read_loop)
+        eventlet.spawn(self._beacon_loop)
 
         if self.stun:
-            self.stun.set_ui(self.ui)
+            self.stun.set_ui(self.events)
             eventlet.spawn(self.stun.run)
 
         # Add our servers to the peer list
         with self._slock:
             for sk in self.servers:
                 server = self.servers[sk]
-                self.ui.peer_add(group='server', sin=server['sin'])
-
-        server_ts = 0
-        client_ts = 0
-        while self.running:
-            ts = time.time()
-            if ts - server_ts > 7:
-                server_ts = ts
-                # Send our server beacons
-                self._server_beacons()
+                self.events.peer_add('server', server)
 
-            if ts - client_ts > 0.5:
-                client_ts = ts
-                # Send a message to the clients
-                self._client_beacons()
+        servers = pacing.Periodic(SERVER_INTERVAL, self._server_beacons)
+        servers.start()
 
-            # Wait a moment
-            eventlet.sleep(0.05)
+        # Everything else happens on the hub; wait here until stopped
+        self._stopped.wait()
+        servers.stop()
 
         # Shutting down, try to tell servers
         self._server_beacons(shutdown=True)
+        if self._capture is not None:
+            self._capture.close()
+
+    def _start_capture(self, path):
+        args = self.args
+        # What the socket is bound to, so that with INADDR_ANY each
+        # peer gets our address towards it
+        self._capture = capture.Capture(path, self.sock.getsockname(),
+                size=args.capturesize * 1024 * 1024, count=args.capturefiles,
+                interval=args.capturetime or None, events=self.events)
+        self.io = capture.CaptureIO(self.io, self._capture)
+
+    def stop(self):
+        """Ask run() to return"""
+        self.running = False
+        if not self._stopped.ready():
+            self._stopped.send()
 
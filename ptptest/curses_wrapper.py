@@ -6,9 +6,13 @@
 Urwid extensions: eventlet-happy Curses implementation
 """
 
-import eventlet
+import sys, eventlet
 from urwid import curses_display
 from eventlet.green import time
+from eventlet.hubs import trampoline
+
+# Longest we wait for a key before looking for a resize
+RESIZE_CHECK        = 0.5
 
 
 class CursesScreen(curses_display.Screen):
@@ -23,21 +27,22 @@ class CursesScreen(curses_display.Screen):
         pass
 
     def _getch(self, wait_tenths):
-        ts = time.time()
-        if wait_tenths is None:
-            while True:
-                ch = self._getch_nodelay()
-                if ch != -1:
-                    return ch
-                eventlet.sleep(0.001)
-
-        while wait_tenths >= 0:
+        # Wait on the hub for stdin, rather than polling it; though not
+        # for too long, as ncurses only reports that the window changed
+        # size when asked for a key
+        deadline = None
+        if wait_tenths is not None:
+            deadline = time.time() + wait_tenths / 10.0
+        while True:
             ch = self._getch_nodelay()
             if ch != -1:
                 return ch
-            wait_tenths -= 1
-            if wait_tenths > 0:
-                eventlet.sleep(0.1)
-
-        return -1
-
+            wait = RESIZE_CHECK
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    return -1
+            try:
+                trampoline(sys.stdin.fileno(), read=True, timeout=wait)
+            except eventlet.Timeout:
+                pass
@@ -0,0 +1,324 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+# Copyright (c) 2014 Chris Luke <chrisy@flirble.org>
+#
+"""Events from the client and server, and their consumers"""
+
+import os, sys, signal, collections
+import eventlet, eventlet.queue
+from eventlet.green import time
+
+# What a consumer may be told about, by the method it is called with
+EVENTS = ('log', 'title', 'peer_add', 'peer_update', 'peer_del',
+        'set_address', 'set_stun')
+
+# Log levels
+DEBUG               = 10
+INFO                = 20
+WARNING             = 30
+ERROR               = 40
+_OFF                = 100
+
+LEVEL_NAMES = {
+        DEBUG: 'DEBUG',
+        INFO: 'INFO',
+        WARNING: 'WARNING',
+        ERROR: 'ERROR',
+}
+
+# How many log records we hold until they are drained
+LOG_RING_SIZE       = 1024
+
+# Default size and number of log files to keep
+LOGFILE_SIZE        = 1024 * 1024
+LOGFILE_COUNT       = 5
+
+
+class Message(object):
+    """A log message as it is handed to the consumers: formatted, with
+    the % operator, the first time str() is called on it, so that one
+    that is never shown, such as a line the UI has no room for, costs
+    next to nothing"""
+
+    __slots__ = ('fmt', 'args', '_text')
+
+    def __init__(self, fmt, args=()):
+        self.fmt = fmt
+        self.args = args
+        self._text = None
+
+    def __str__(self):
+        if self._text is None:
+            try:
+                self._text = self.fmt % self.args if self.args else self.fmt
+            except (TypeError, ValueError), e:
+                # As with Lazy, there is nobody here to catch it; a bad
+                # message must not take the log down with it
+                self._text = "%s %r <formatting failed: %s>" % (self.fmt, self.args, e)
+        return self._text
+
+
+class Lazy(object):
+    """An argument to a log message that is only worked out, by calling
+    f(*args), when the message is formatted; for debugging output that
+    is costly to produce, such as a parse or a hexdump of a packet"""
+
+    __slots__ = ('f', 'args')
+
+    def __init__(self, f, *args):
+        self.f = f
+        self.args = args
+
+    def _render(self, how):
+        # This happens far from whoever logged it, where there is
+        # nobody to catch anything
+        try:
+            return how(self.f(*self.args))
+        except Exception, e:
+            return "<%s failed: %s>" % (getattr(self.f, '__name__', 'debug output'), e)
+
+    def __str__(self):
+        return self._render(str)
+
+    def __repr__(self):
+        return self._render(repr)
+
+
+class Events(object):
+    """Passes what the client or server is doing on to the consumers
+    that have subscribed.
+
+    A consumer is anything with some of the methods named in EVENTS, and
+    is only called for those it has; so an event nobody wants, such as
+    peer_update when there is no UI, costs next to nothing.
+
+    Log messages have a level, and those that get past it are held in a
+    ring of LOG_RING_SIZE records, the oldest dropped if it fills, and
+    handed to the consumers by a greenlet of their own, so that whoever
+    logs never waits on a screen or a disk; other events, but for
+    peer_update, have the ring flushed ahead of them, so that they are
+    not seen before what was logged first. They go as Messages, which
+    are only formatted, with the % operator and any arguments given,
+    when a consumer turns them into a string.
+
+    Debugging output that comes with every packet is guarded by
+    sampled(), so that it can be cut to one packet in every sample."""
+
+    def __init__(self, level=INFO, sample=1):
+        super(Events, self).__init__()
+        self.level = level
+        self.sample = sample
+        self.dropped = 0
+        self._sampled = 0
+        self._consumers = []
+        for name in EVENTS:
+            setattr(self, '_' + name, ())
+        self._level = _OFF
+        self._ring = collections.deque(maxlen=LOG_RING_SIZE)
+        self._wakeup = eventlet.queue.LightQueue()
+        self._kicked = False
+        eventlet.spawn(self._drain)
+
+    def subscribe(self, consumer):
+        self._consumers.append(consumer)
+        for name in EVENTS:
+            setattr(self, '_' + name, tuple(getattr(c, name)
+                for c in self._consumers if hasattr(c, name)))
+        self.set_level(self.level)
+
+    def set_level(self, level):
+        self.level = level
+        # Nothing gets past if nobody would see it
+        self._level = level if self._log else _OFF
+
+    def enabled(self, level):
+        return level >= self._level
+
+    def sampled(self, level=DEBUG):
+        """Like enabled(), for the messages about a packet: true for only
+        one in every sample of the calls that it would be true for"""
+        if level < self._level:
+            return False
+        self._sampled += 1
+        if self._sampled < self.sample:
+            return False
+        self._sampled = 0
+        return True
+
+    def _record(self, level, fmt, args, kw):
+        ring = self._ring
+        if len(ring) == ring.maxlen:
+            self.dropped += 1
+        ring.append((time.time(), level, fmt, args,
+            kw.get('indent', ''), kw.get('stdout', False)))
+        if not self._kicked:
+            self._kicked = True
+            self._wakeup.put(None)
+
+    def debug(self, fmt, *args, **kw):
+        if DEBUG >= self._level:
+            self._record(DEBUG, fmt, args, kw)
+
+    def log(self, fmt, *args, **kw):
+        if INFO >= self._level:
+            self._record(INFO, fmt, args, kw)
+
+    info = log
+
+    def warning(self, fmt, *args, **kw):
+        if WARNING >= self._level:
+            self._record(WARNING, fmt, args, kw)
+
+    def error(self, fmt, *args, **kw):
+        if ERROR >= self._level:
+            self._record(ERROR, fmt, args, kw)
+
+    def _drain(self):
+        while True:
+            self._wakeup.get()
+            self._kicked = False
+            self.flush()
+
+    def flush(self):
+        """Hand what is in the ring to the consumers now"""
+        ring = self._ring
+        if self.dropped:
+            (dropped, self.dropped) = (self.dropped, 0)
+            for f in self._log:
+                f("%d log messages were dropped" % dropped, level=WARNING)
+        while ring:
+            (ts, level, fmt, args, indent, stdout) = ring.popleft()
+            text = Message(fmt, args)
+            for f in self._log:
+                f(text, stdout=stdout, indent=indent, level=level, ts=ts)
+
+    # The events below go to the consumers straight away, so what was
+    # logged before them is flushed first, to keep them in order.
+    # peer_update is left alone: it comes with every packet, and only
+    # the UI, which shows peers apart from the log, wants it.
+
+    def title(self, text, stdout=False):
+        if self._title:
+            self.flush()
+        for f in self._title:
+            f(text, stdout=stdout)
+
+    def peer_add(self, group, peer):
+        if self._peer_add:
+            self.flush()
+        for f in self._peer_add:
+            f(group, peer)
+
+    def peer_update(self, group, peer):
+        for f in self._peer_update:
+            f(group, peer)
+
+    def peer_del(self, group, peer):
+        if self._peer_del:
+            self.flush()
+        for f in self._peer_del:
+            f(group, peer)
+
+    def set_address(self, address, port):
+        if self._set_address:
+            self.flush()
+        for f in self._set_address:
+            f(address, port)
+
+    def set_stun(self, nat_type, external_ip, external_port):
+        if self._set_stun:
+            self.flush()
+        for f in self._set_stun:
+            f(nat_type, external_ip, external_port)
+
+
+class Printer(object):
+    """Writes events as lines on stdout, for running headless; under
+    systemd these end up in the journal. Peer updates, which come with
+    every packet, are left out."""
+
+    def __init__(self, prefix='', out=sys.stdout):
+        super(Printer, self).__init__()
+        self.prefix = prefix
+        self.out = out
+
+    def _write(self, line):
+        self.out.write(self.prefix + line + "\n")
+        self.out.flush()
+
+    def log(self, text, stdout=False, indent='', level=INFO, ts=None):
+        for line in str(text).split("\n"):
+            self._write(indent + line)
+
+    def title(self, text, stdout=False):
+        self._write(text)
+
+    def peer_add(self, group, peer):
+        self._write("Peer added: %s %s:%d" % ((group,) + peer.sin[:2]))
+
+    def peer_del(self, group, peer):
+        self._write("Peer removed: %s %s:%d" % ((group,) + peer.sin[:2]))
+        if peer.seqs is not None:
+            seqs = peer.seqs
+            self._write("  Lost %d (%d bursts), reordered %d, duplicates %d, late %d" % (
+                    seqs.lost, seqs.bursts, seqs.reordered, seqs.duplicates, seqs.late))
+        if peer.rtts is not None:
+            self._write("  RTT min/mean/p50/p99/max %(min).6f/%(mean).6f/%(p50).6f/"
+                    "%(p99).6f/%(max).6f, jitter %(jitter).6f" % peer.rtts.summary())
+        if peer.rx_delays is not None:
+            self._write("  Receive delay min/mean/p50/p99/max %(min).6f/%(mean).6f/"
+                    "%(p50).6f/%(p99).6f/%(max).6f" % peer.rx_delays.summary())
+        if peer.clocks is not None:
+            self._write("  Clock offset %(offset).6f (delay %(delay).6f), one-way "
+                    "%(forward).6f/%(backward).6f, queueing %(fwd_queue).6f/"
+                    "%(back_queue).6f" % peer.clocks.summary())
+
+    def set_address(self, address, port):
+        self._write("Address: %s:%s" % (address, port))
+
+    def set_stun(self, nat_type, external_ip, external_port):
+        self._write("NAT type: %s, address %s" % (nat_type, external_ip))
+
+
+
+class FileLog(object):
+    """Writes log messages to a file, starting a new one when it gets to
+    size bytes and keeping count old ones as path.1, path.2 and so on."""
+
+    def __init__(self, path, size=LOGFILE_SIZE, count=LOGFILE_COUNT):
+        super(FileLog, self).__init__()
+        self.path = path
+        self.size = size
+        self.count = count
+        self._file = open(path, 'a')
+
+    def _rotate(self):
+        self._file.close()
+        for n in xrange(self.count - 1, 0, -1):
+            old = "%s.%d" % (self.path, n)
+            if os.path.exists(old):
+                os.rename(old, "%s.%d" % (self.path, n + 1))
+        if self.count:
+            os.rename(self.path, self.path + ".1")
+        self._file = open(self.path, 'w')
+
+    def log(self, text, stdout=False, indent='', level=INFO, ts=None):
+        if ts is None:
+            ts = time.time()
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts))
+        stamp += ".%03d %-7s " % (int(ts * 1000) % 1000, LEVEL_NAMES.get(level, level))
+        self._file.write(''.join(stamp + indent + line + "\n" for line in str(text).split("\n")))
+        self._file.flush()
+        if self._file.tell() >= self.size:
+            self._rotate()
+
+    def title(self, text, stdout=False):
+        self.log(text)
+
+
+def handle_signals(parent):
+    """Stop parent on SIGINT or SIGTERM, as the UI would when asked to"""
+    def stop(signum, frame):
+        parent.stop()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
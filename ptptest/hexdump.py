@@ -133,40 +133,57 @@ def dump(binary):
     hexstr = hexstr.decode('ascii')
   return ' '.join(chunks(hexstr.upper(), 2))
 
+# printable ASCII range 0x20 to 0x7E, everything else a '.'
+_PRINTABLE = bytes(bytearray(b if 0x20 <= b <= 0x7E else 0x2E for b in range(256)))
+
+# bytes formatted at a time; a multiple of 16
+_BLOCK = 4096
+
+def _dumpblock(data, base):
+  '''
+  Generator of the lines for one block of data, starting at address
+  base; the whole block is hexlified and translated in one go, and
+  each line is then cut from those.
+  '''
+  n = len(data)
+  hexstr = binascii.hexlify(data).upper()
+  spaced = bytearray(b' ') * (3*n)
+  spaced[0::3] = hexstr[0::2]
+  spaced[1::3] = hexstr[1::2]
+  text = data.translate(_PRINTABLE)
+  if PY3K:
+    spaced = spaced.decode('ascii')
+    text = text.decode('ascii')
+  else:
+    spaced = str(spaced)
+
+  for off in range(0, n, 16):
+    # 00000000: 00 00 00 00 00 00 00 00  00 00 00 00 00 00 00 00  ................
+    m = min(16, n - off)
+    if m == 16:
+      yield '%08X: %s %s %s' % (base + off, spaced[3*off:3*off+24],
+          spaced[3*off+24:3*off+48], text[off:off+16])
+      continue
+    # the last line; calculate indentation
+    dumpstr = spaced[3*off:3*off+3*m-1]
+    if m > 8:  # insert separator if needed
+      dumpstr = dumpstr[:8*3] + ' ' + dumpstr[8*3:]
+    pad = 2 + 3*(16 - m)
+    if m <= 8:
+      pad += 1
+    yield '%08X: %s%s%s' % (base + off, dumpstr, ' '*pad, text[off:off+m])
+
 def dumpgen(data):
   '''
   Generator that produces strings:
 
   '00000000: 00 00 00 00 00 00 00 00  00 00 00 00 00 00 00 00  ................'
   '''
-  generator = genchunks(data, 16)
+  generator = genchunks(data, _BLOCK)
   for addr, d in enumerate(generator):
-    # 00000000:
-    line = '%08X: ' % (addr*16)
-    # 00 00 00 00 00 00 00 00  00 00 00 00 00 00 00 00 
-    dumpstr = dump(d)
-    line += dumpstr[:8*3]
-    if len(d) > 8:  # insert separator if needed
-      line += ' ' + dumpstr[8*3:]
-    # ................
-    # calculate indentation, which may be different for the last line
-    pad = 2
-    if len(d) < 16:
-      pad += 3*(16 - len(d))
-    if len(d) <= 8:
-      pad += 1
-    line += ' '*pad
-
-    for byte in d:
-      # printable ASCII range 0x20 to 0x7E
-      if not PY3K:
-        byte = ord(byte)
-      if 0x20 <= byte <= 0x7E:
-        line += chr(byte)
-      else:
-        line += '.'
-    yield line
-  
+    for line in _dumpblock(bytes(d), addr*_BLOCK):
+      yield line
+
 def hexdump(data, result='print'):
   '''
   Transform binary data to the hex dump text format:
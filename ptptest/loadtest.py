@@ -0,0 +1,123 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+# Copyright (c) 2014 Chris Luke <chrisy@flirble.org>
+#
+"""Load generator for the PTP server"""
+
+import os, uuid
+import eventlet, eventlet.hubs, eventlet.timeout
+from eventlet.green import socket
+from eventlet.green import time
+
+import protocol, client
+
+# Seconds at the start of a run that are not counted, while clients join
+WARMUP = 1
+
+
+def _request(uid, seq, sin, ts, shutdown=False):
+    l = [
+        protocol.encode_uint(protocol.PTP_TYPE_CLIENTVER, 1, client.PTP_CLIENTVER),
+        protocol.encode_uint(protocol.PTP_TYPE_SEQUENCE, 4, seq),
+        protocol.encode_string(protocol.PTP_TYPE_UUID, uid),
+        protocol.encode_address(protocol.PTP_TYPE_PTPADDR, sin),
+    ]
+    if shutdown:
+        l.append(protocol.encode_uint(protocol.PTP_TYPE_SHUTDOWN, 1, 1))
+    else:
+        l.append(protocol.encode_uint(protocol.PTP_TYPE_MYTS, 8, ts))
+    return protocol.encode(''.join(l))
+
+
+def _client(server, start, end, stats):
+    """One client, with one request outstanding at a time"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(('0.0.0.0', 0))
+    sin = ('127.0.0.1', s.getsockname()[1])
+    uid = uuid.uuid4().bytes
+    seq = 0
+
+    while time.time() < end:
+        seq += 1
+        sent = time.time()
+        s.sendto(_request(uid, seq, sin, seq), server)
+        counted = sent >= start
+        if counted:
+            stats['sent'] += 1
+
+        # Wait for the answer to this request; beacons are ignored
+        try:
+            with eventlet.timeout.Timeout(1):
+                while True:
+                    (buf, frm) = s.recvfrom(protocol.PTP_MTU)
+                    try:
+                        l = protocol.decode(buf)
+                    except protocol.DecodeError:
+                        continue
+                    if (protocol.PTP_TYPE_YOURTS, seq) in l:
+                        break
+        except eventlet.timeout.Timeout:
+            continue
+
+        if counted:
+            stats['answered'] += 1
+            stats['rtt'] += time.time() - sent
+
+    s.sendto(_request(uid, seq + 1, sin, 0, shutdown=True), server)
+    s.close()
+
+
+def _generate(args, clients, start, end, fd):
+    server = (args.server, args.port)
+    stats = {'sent': 0, 'answered': 0, 'rtt': 0.0}
+    pool = eventlet.GreenPool(clients)
+    for i in xrange(clients):
+        pool.spawn(_client, server, start, end, stats)
+    pool.waitall()
+    os.write(fd, "%d %d %f\n" % (stats['sent'], stats['answered'], stats['rtt']))
+
+
+def run(args):
+    """Run args.clients clients, spread over args.procs processes, each
+    sending a request for a timestamp reply as soon as it has the answer
+    to its last one, for args.time seconds. Prints the rate of answers."""
+    start = time.time() + WARMUP
+    end = start + args.time
+    (rfd, wfd) = os.pipe()
+
+    pids = []
+    for proc in xrange(args.procs):
+        clients = args.clients // args.procs + (proc < args.clients % args.procs)
+        pid = os.fork()
+        if pid == 0:
+            eventlet.hubs.use_hub()
+            os.close(rfd)
+            try:
+                _generate(args, clients, start, end, wfd)
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    os.close(wfd)
+
+    results = ''
+    while True:
+        data = os.read(rfd, 4096)
+        if not data:
+            break
+        results += data
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+    (sent, answered, rtt) = (0, 0, 0.0)
+    for line in results.splitlines():
+        (s, a, r) = line.split()
+        sent += int(s)
+        answered += int(a)
+        rtt += float(r)
+
+    print("%d clients in %d processes for %ds: %d requests, %d answered" %
+            (args.clients, args.procs, args.time, sent, answered))
+    print("%.0f answers/s, %.1f%% lost, mean RTT %.3fms" % (
+            answered / float(args.time),
+            100.0 * (sent - answered) / max(1, sent),
+            1000.0 * rtt / max(1, answered)))
@@ -0,0 +1,278 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+# Copyright (c) 2014 Chris Luke <chrisy@flirble.org>
+#
+"""Batched datagram I/O"""
+
+import os, sys, errno, struct, contextlib
+import ctypes, ctypes.util
+from eventlet.green import socket
+from eventlet.hubs import trampoline
+
+# How many datagrams we move per system call
+BATCH = 64
+
+
+class DatagramIO(object):
+    """Datagram I/O on a (green) socket, one system call per datagram.
+
+    recv() blocks for and returns a list of (buf, sin, ts), with ts the
+    time the kernel received the datagram, in nanoseconds since the
+    epoch, if timestamps is set, or None; sendto() sends straight away,
+    unless inside batch() when the datagrams are held until the
+    outermost batch() finishes.
+
+    A datagram the kernel will not send, say to port 0 for a peer that
+    claims it, is counted in send_errors and dropped, as if lost on
+    the way; it is not raised, as nobody sending could do better with
+    it, and from batch() it would take down whatever loop was sending.
+    Each kind of error is logged the first time, to events if given.
+
+    Without recvmsg there is no way to get at the timestamps, so this
+    leaves timestamps False."""
+
+    timestamps = False
+
+    def __init__(self, sock, size, events=None):
+        super(DatagramIO, self).__init__()
+        self.sock = sock
+        self.size = size
+        self.events = events
+        self.send_errors = 0
+        self._warned = set()
+        self._queue = []
+        self._depth = 0
+
+    def recv(self):
+        (buf, sin) = self.sock.recvfrom(self.size)
+        return [(buf, sin, None)]
+
+    def sendto(self, packet, sin):
+        if self._depth:
+            self._queue.append((packet, sin))
+            if len(self._queue) >= BATCH:
+                self.flush()
+        else:
+            self._sendto(packet, sin)
+
+    def _sendto(self, packet, sin):
+        try:
+            self.sock.sendto(packet, sin)
+        except socket.error, e:
+            self._failed(e.errno, sin)
+
+    def _failed(self, err, sin):
+        self.send_errors += 1
+        if self.events is not None and err not in self._warned:
+            self._warned.add(err)
+            self.events.warning("Sending to %s:%d failed: %s (%d send errors so far)",
+                    sin[0], sin[1], os.strerror(err), self.send_errors)
+
+    def flush(self):
+        queue = self._queue
+        self._queue = []
+        for (packet, sin) in queue:
+            self._sendto(packet, sin)
+
+    @contextlib.contextmanager
+    def batch(self):
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            if not self._depth and self._queue:
+                self.flush()
+
+
+#
+# recvmmsg(2) and sendmmsg(2), for Linux
+#
+
+class _iovec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t),
+    ]
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(_iovec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_hdr', _msghdr),
+        ('msg_len', ctypes.c_uint),
+    ]
+
+_MSG_DONTWAIT = 0x40
+_SO_TIMESTAMPNS = 35 # and SCM_TIMESTAMPNS
+# Room for one struct cmsghdr and a struct timespec, with some to spare
+_CONTROL_SIZE = 64
+_CMSG = struct.Struct('@Lii')
+_CMSG_ALIGN = ctypes.sizeof(ctypes.c_long)
+_TIMESPEC = struct.Struct('@ll')
+_SOCKADDR_SIZE = 128 # sizeof(struct sockaddr_storage)
+_FAMILY = struct.Struct('=H')
+_SIN = struct.Struct('=H2s4s8x')
+_SIN6 = struct.Struct('=H2sI16sI')
+_PORT = struct.Struct('!H')
+
+_libc = None
+if sys.platform.startswith('linux'):
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr),
+                ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        _libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr),
+                ctypes.c_uint, ctypes.c_int]
+    except (OSError, AttributeError):
+        _libc = None
+
+def available():
+    """True if we can use recvmmsg and sendmmsg here"""
+    return _libc is not None
+
+def _unpack_sockaddr(raw):
+    family = _FAMILY.unpack_from(raw)[0]
+    if family == socket.AF_INET:
+        (family, port, addr) = _SIN.unpack_from(raw)
+        return (socket.inet_ntoa(addr), _PORT.unpack(port)[0])
+    (family, port, flow, addr, scope) = _SIN6.unpack_from(raw)
+    return (socket.inet_ntop(socket.AF_INET6, addr), _PORT.unpack(port)[0], flow, scope)
+
+def _pack_sockaddr(sin):
+    if ':' not in sin[0]:
+        return _SIN.pack(socket.AF_INET, _PORT.pack(sin[1]), socket.inet_aton(sin[0]))
+    flow = sin[2] if len(sin) > 2 else 0
+    scope = sin[3] if len(sin) > 3 else 0
+    return _SIN6.pack(socket.AF_INET6, _PORT.pack(sin[1]), flow,
+            socket.inet_pton(socket.AF_INET6, sin[0]), scope)
+
+
+def _timestamp(raw, n):
+    """The SCM_TIMESTAMPNS in the n bytes of control messages in raw,
+    in nanoseconds, or None"""
+    off = 0
+    while off + _CMSG.size <= n:
+        (ln, level, t) = _CMSG.unpack_from(raw, off)
+        if ln < _CMSG.size:
+            break
+        if level == socket.SOL_SOCKET and t == _SO_TIMESTAMPNS:
+            (sec, nsec) = _TIMESPEC.unpack_from(raw, off + _CMSG.size)
+            return sec * 1000000000 + nsec
+        off += (ln + _CMSG_ALIGN - 1) & ~(_CMSG_ALIGN - 1)
+    return None
+
+
+class MmsgIO(DatagramIO):
+    """Datagram I/O that moves up to BATCH datagrams per system call
+    with recvmmsg and sendmmsg, through buffers allocated up front.
+
+    With timestamps set, the kernel is asked for SO_TIMESTAMPNS, and
+    the time each datagram arrived comes with it.
+
+    A datagram the kernel will not send is dropped as DatagramIO does,
+    and the rest of the batch still goes."""
+
+    def __init__(self, sock, size, timestamps=False, events=None):
+        super(MmsgIO, self).__init__(sock, size, events)
+        self.fd = sock.fileno()
+        self.timestamps = timestamps
+        if timestamps:
+            sock.setsockopt(socket.SOL_SOCKET, _SO_TIMESTAMPNS, 1)
+            self._rctls = [ctypes.create_string_buffer(_CONTROL_SIZE) for i in xrange(BATCH)]
+
+        self._rbufs = [ctypes.create_string_buffer(size) for i in xrange(BATCH)]
+        self._rnames = [ctypes.create_string_buffer(_SOCKADDR_SIZE) for i in xrange(BATCH)]
+        self._riov = (_iovec * BATCH)()
+        self._rmsgs = (_mmsghdr * BATCH)()
+        for i in xrange(BATCH):
+            self._riov[i].iov_base = ctypes.addressof(self._rbufs[i])
+            self._riov[i].iov_len = size
+            hdr = self._rmsgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self._rnames[i])
+            hdr.msg_iov = ctypes.pointer(self._riov[i])
+            hdr.msg_iovlen = 1
+            if timestamps:
+                hdr.msg_control = ctypes.addressof(self._rctls[i])
+
+        self._snames = [ctypes.create_string_buffer(_SOCKADDR_SIZE) for i in xrange(BATCH)]
+        self._siov = (_iovec * BATCH)()
+        self._smsgs = (_mmsghdr * BATCH)()
+        for i in xrange(BATCH):
+            hdr = self._smsgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self._snames[i])
+            hdr.msg_iov = ctypes.pointer(self._siov[i])
+            hdr.msg_iovlen = 1
+
+    def recv(self):
+        msgs = self._rmsgs
+        while True:
+            for i in xrange(BATCH):
+                msgs[i].msg_hdr.msg_namelen = _SOCKADDR_SIZE
+                if self.timestamps:
+                    msgs[i].msg_hdr.msg_controllen = _CONTROL_SIZE
+            n = _libc.recvmmsg(self.fd, msgs, BATCH, _MSG_DONTWAIT, None)
+            if n > 0:
+                break
+            err = ctypes.get_errno()
+            if n == 0 or err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                trampoline(self.fd, read=True)
+            elif err != errno.EINTR:
+                raise socket.error(err, 'recvmmsg: ' + errno.errorcode.get(err, str(err)))
+
+        l = []
+        for i in xrange(n):
+            buf = ctypes.string_at(self._rbufs[i], msgs[i].msg_len)
+            ts = None
+            if self.timestamps:
+                ts = _timestamp(self._rctls[i].raw, msgs[i].msg_hdr.msg_controllen)
+            l.append((buf, _unpack_sockaddr(self._rnames[i].raw), ts))
+        return l
+
+    def flush(self):
+        while self._queue:
+            queue = self._queue[:BATCH]
+            self._queue = self._queue[BATCH:]
+            self._send(queue)
+
+    def _send(self, queue):
+        msgs = self._smsgs
+        for (i, (packet, sin)) in enumerate(queue):
+            name = _pack_sockaddr(sin)
+            ctypes.memmove(self._snames[i], name, len(name))
+            msgs[i].msg_hdr.msg_namelen = len(name)
+            # queue keeps packet alive until we are done with it
+            self._siov[i].iov_base = ctypes.cast(ctypes.c_char_p(packet), ctypes.c_void_p)
+            self._siov[i].iov_len = len(packet)
+
+        done = 0
+        while done < len(queue):
+            n = _libc.sendmmsg(self.fd, ctypes.byref(msgs[done]), len(queue) - done, _MSG_DONTWAIT)
+            if n > 0:
+                done += n
+                continue
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                trampoline(self.fd, write=True)
+            elif err != errno.EINTR:
+                # The first datagram left is the one that failed
+                self._failed(err, queue[done][1])
+                done += 1
+
+
+def datagram_io(sock, size, batched=True, timestamps=False, events=None):
+    """Returns the best datagram I/O we have for sock. Kernel timestamps
+    come with recvmmsg; the timestamps attribute of what comes back
+    says if they are there."""
+    if batched and available():
+        return MmsgIO(sock, size, timestamps=timestamps, events=events)
+    return DatagramIO(sock, size, events=events)
@@ -0,0 +1,123 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+# Copyright (c) 2014 Chris Luke <chrisy@flirble.org>
+#
+"""Timers and rate limiting for sending packets"""
+
+import heapq
+import eventlet
+from eventlet.green import time
+
+
+class TokenBucket(object):
+    """A token bucket filling at rate tokens a second, up to burst.
+
+    Tokens may be consumed beyond what is there; the debt is then paid
+    off before delay() says anything else can go."""
+
+    def __init__(self, rate, burst=None):
+        super(TokenBucket, self).__init__()
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate / 10))
+        self._tokens = self.burst
+        self._ts = time.time()
+
+    def _fill(self):
+        now = time.time()
+        self._tokens = min(self.burst, self._tokens + (now - self._ts) * self.rate)
+        self._ts = now
+
+    def delay(self, n=1):
+        """Seconds until n tokens are available"""
+        self._fill()
+        if self._tokens >= n:
+            return 0
+        return (n - self._tokens) / self.rate
+
+    def consume(self, n=1):
+        self._fill()
+        self._tokens -= n
+
+
+class Schedule(object):
+    """Per-key deadlines, in deadline order.
+
+    Each key has at most one deadline; rescheduling or cancelling a key
+    leaves its old heap entry behind to be skipped when it surfaces."""
+
+    def __init__(self):
+        super(Schedule, self).__init__()
+        self._heap = []
+        self._due = {}      # key -> deadline
+
+    def __len__(self):
+        return len(self._due)
+
+    def __contains__(self, key):
+        return key in self._due
+
+    def schedule(self, key, deadline):
+        """Set (or move) the deadline for key"""
+        self._due[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+
+    def cancel(self, key):
+        self._due.pop(key, None)
+
+    def _clean(self):
+        heap = self._heap
+        while heap and self._due.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+
+    def next(self):
+        """The earliest deadline, or None if there are none"""
+        self._clean()
+        if self._heap:
+            return self._heap[0][0]
+        return None
+
+    def expire(self, now):
+        """Remove and return (key, deadline) for each key that is due"""
+        due = []
+        heap = self._heap
+        while True:
+            self._clean()
+            if not heap or heap[0][0] > now:
+                break
+            (deadline, key) = heapq.heappop(heap)
+            del(self._due[key])
+            due.append((key, deadline))
+        return due
+
+
+class Periodic(object):
+    """Calls f every interval seconds, from a hub timer, rather than
+    from a loop that keeps waking up to look at the clock.
+
+    Calls are on a fixed schedule, so they do not drift by however long
+    f takes; if f overruns, the calls that were missed are skipped."""
+
+    def __init__(self, interval, f):
+        super(Periodic, self).__init__()
+        self.interval = interval
+        self.f = f
+        self._next = None
+        self._timer = None
+
+    def start(self, delay=0):
+        self.stop()
+        self._next = time.time() + delay
+        self._timer = eventlet.spawn_after(delay, self._tick)
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _tick(self):
+        now = time.time()
+        self._next += self.interval
+        if self._next < now:
+            self._next = now + self.interval
+        self._timer = eventlet.spawn_after(self._next - now, self._tick)
+        self.f()
@@ -0,0 +1,401 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+# Copyright (c) 2014 Chris Luke <chrisy@flirble.org>
+#
+"""Peer records"""
+
+import array
+
+# How many of the latest RTTs we keep for each peer
+RTT_SAMPLES         = 256
+
+# How far back we remember which sequence numbers arrived; one that
+# hasn't by the time it drops out of this window is counted as lost
+SEQ_WINDOW          = 64
+
+# A jump in sequence numbers further than this either way is taken to
+# be the peer starting again, not loss
+SEQ_RESYNC          = 65536
+
+# How many of the latest timestamp exchanges with a peer we keep, and
+# of those, among how many the one with the least delay is taken to
+# give the clock offset; 8 is what NTP's clock filter uses
+CLOCK_SAMPLES       = 64
+CLOCK_FILTER        = 8
+
+_SEQ_MOD            = 1 << 32   # sequence numbers are 4 bytes
+
+# What we tell others about a peer in META, under short names so that it
+# fits in a TLV, and the statistics, which go as a list in this order.
+# The peer's address is not among them; it is in the key META has it under
+_META = (('n', 'name'), ('t', 'ts'), ('v', 'serverver'), ('q', 'sequence'), ('m', 'myts'))
+_STATS = ('sent', 'rcvd', 'ackd', 'rtt', 'lost', 'reordered', 'duplicates')
+
+
+class Peer(object):
+    """What we know about a client or server we talk to.
+
+    These are kept in dicts keyed by the peer's (addr, port), the same
+    tuple the socket gives us, so looking one up per packet costs no
+    more than a hash of that tuple. Using __slots__ keeps each of them
+    to a fraction of the size of the dicts they replace."""
+
+    __slots__ = (
+        'sin',          # (addr, port) we talk to it at
+        'name',         # hostname, for servers
+        'ts',           # when we last heard from it
+        'uuid',
+        'serverver',
+        'clientver',
+        'sequence',     # its last sequence number
+        'myseq',        # our next sequence number to it
+        'myts',         # its clock, when it last answered a timestamp
+        'gen',          # generation of its client list
+        'ptpaddr',      # its own idea of its address
+        'sent',
+        'rcvd',
+        'ackd',
+        'rtt',          # the latest RTT
+        'rtts',         # RTTStats, once there is an RTT
+        'seqs',         # SeqStats, once there is a sequence number
+        'clocks',       # ClockStats, once it answers with its own times
+        'rx_delays',    # RTTStats of how long its packets waited for us,
+                        # once there is a kernel timestamp
+        'beacon',       # protocol.Template of what we send it
+        'echo',         # and of our replies to its timestamps
+    )
+
+    def __init__(self, sin, name=None, ts=None):
+        self.sin = sin
+        self.name = name
+        self.ts = ts
+        self.uuid = None
+        self.serverver = None
+        self.clientver = 0
+        self.sequence = None
+        self.myseq = 0L
+        self.myts = None
+        self.gen = 0
+        self.ptpaddr = None
+        self.sent = 0
+        self.rcvd = 0
+        self.ackd = 0
+        self.rtt = 0
+        self.rtts = None
+        self.seqs = None
+        self.clocks = None
+        self.rx_delays = None
+        self.beacon = None
+        self.echo = None
+
+    def seen(self, seq):
+        """Note a sequence number from the peer"""
+        if self.seqs is None:
+            self.seqs = SeqStats()
+        self.seqs.add(seq)
+
+    @property
+    def lost(self):
+        return self.seqs.lost if self.seqs is not None else 0
+
+    @property
+    def reordered(self):
+        return self.seqs.reordered if self.seqs is not None else 0
+
+    @property
+    def duplicates(self):
+        return self.seqs.duplicates if self.seqs is not None else 0
+
+    def add_rtt(self, rtt):
+        if self.rtts is None:
+            self.rtts = RTTStats()
+        self.rtts.add(rtt)
+        self.rtt = rtt
+
+    def add_exchange(self, t1, t4, t4_real, t2=None, t3=None):
+        """Note the answer to one of our timestamps, and return the RTT.
+
+        t1 is when we sent it and t4 when the answer came, by our
+        monotonic clock, with t4_real the time by our realtime clock;
+        t2 and t3 are when the peer got it and answered, by its realtime
+        clock, if it said. All are in nanoseconds."""
+        rtt = t4 - t1
+        if t2 is not None and t3 is not None and t2 <= t3:
+            # Not counting the time it took to answer
+            rtt -= t3 - t2
+            if self.clocks is None:
+                self.clocks = ClockStats()
+            # Our clocks did not step in the time that took, we hope
+            self.clocks.add(t1 + t4_real - t4, t2, t3, t4_real)
+            self.myts = t3 / 1e9
+        rtt /= 1e9
+        self.add_rtt(rtt)
+        return rtt
+
+    def add_rx_delay(self, delay):
+        """Note how long a packet from the peer was in the kernel before
+        we got to it"""
+        if self.rx_delays is None:
+            self.rx_delays = RTTStats()
+        self.rx_delays.add(delay)
+
+    @property
+    def rx_delay(self):
+        return self.rx_delays.mean if self.rx_delays is not None else 0.0
+
+    @property
+    def offset(self):
+        return self.clocks.summary()['offset'] if self.clocks is not None else 0.0
+
+    @property
+    def queueing(self):
+        if self.clocks is None:
+            return '-'
+        s = self.clocks.summary()
+        return '%.6f/%.6f' % (s['fwd_queue'], s['back_queue'])
+
+    @property
+    def rtt_mean(self):
+        return self.rtts.mean if self.rtts is not None else 0.0
+
+    @property
+    def rtt_p99(self):
+        return self.rtts.summary()['p99'] if self.rtts is not None else 0.0
+
+    @property
+    def jitter(self):
+        return self.rtts.jitter if self.rtts is not None else 0.0
+
+    def meta(self):
+        """A dict describing this peer, for a META TLV; times are to
+        the millisecond and the RTT to the microsecond"""
+        d = {}
+        for (k, f) in _META:
+            v = getattr(self, f)
+            if v is not None:
+                d[k] = round(v, 3) if isinstance(v, float) else v
+        d['s'] = s = [getattr(self, f) for f in _STATS]
+        s[3] = round(s[3], 6)
+        return d
+
+    def __repr__(self):
+        return "<Peer %s:%d>" % self.sin[:2]
+
+
+class RTTStats(object):
+    """The last RTT_SAMPLES RTTs of a peer, in a ring of 4-byte floats,
+    and their RFC 3550 interarrival jitter.
+
+    Each sample costs a store and a few additions; the percentiles in
+    summary() take one sort of the ring, in C, and are kept until the
+    next sample. A peer's ring takes about 1KB."""
+
+    __slots__ = ('samples', 'count', 'jitter', '_sum', '_last', '_summary')
+
+    def __init__(self):
+        self.samples = array.array('f', [0.0]) * RTT_SAMPLES
+        self.count = 0
+        self.jitter = 0.0
+        self._sum = 0.0     # of the samples in the ring
+        self._last = None
+        self._summary = None
+
+    def add(self, rtt):
+        samples = self.samples
+        i = self.count % RTT_SAMPLES
+        if self.count >= RTT_SAMPLES:
+            self._sum -= samples[i]
+        samples[i] = rtt
+        if i == RTT_SAMPLES - 1:
+            # Start afresh every lap, so rounding can't build up
+            self._sum = sum(samples)
+        else:
+            self._sum += samples[i]
+
+        if self._last is not None:
+            # J += (|D| - J) / 16, with D the change in (round trip) time
+            self.jitter += (abs(rtt - self._last) - self.jitter) / 16
+        self._last = rtt
+        self.count += 1
+        self._summary = None
+
+    def __len__(self):
+        return min(self.count, RTT_SAMPLES)
+
+    @property
+    def mean(self):
+        n = len(self)
+        return self._sum / n if n else 0.0
+
+    def summary(self):
+        """A dict of the min, mean, p50, p99 and max of the RTTs in the
+        ring, and the jitter"""
+        if self._summary is None:
+            n = len(self)
+            s = sorted(self.samples[:n]) or [0.0]
+            # Nearest rank
+            rank = lambda p: s[max(0, -(-p * n // 100) - 1)]
+            self._summary = {
+                'min': s[0],
+                'mean': self.mean,
+                'p50': rank(50),
+                'p99': rank(99),
+                'max': s[-1],
+                'jitter': self.jitter,
+            }
+        return self._summary
+
+
+class SeqStats(object):
+    """Which of the last SEQ_WINDOW sequence numbers from a peer have
+    arrived, as the bits of an int, and what that says about them.
+
+    Bit n is set once the number n below the highest so far has
+    arrived. One that arrives below the highest is reordered if its
+    bit was clear and a duplicate if not; one whose bit is still clear
+    when it drops out of the window is lost, and a run of two or more
+    of those is a burst. Anything older than the window is late, and
+    was counted as lost already.
+
+    Packets usually move the window on by one, so each costs a shift,
+    a mask and a compare."""
+
+    __slots__ = ('top', 'bits', 'lost', 'reordered', 'duplicates',
+            'late', 'bursts', '_run', '_before')
+
+    _MASK = (1 << SEQ_WINDOW) - 1
+
+    def __init__(self):
+        self.top = None
+        self.bits = 0
+        self.lost = 0
+        self.reordered = 0
+        self.duplicates = 0
+        self.late = 0
+        self.bursts = 0
+        self._run = 0       # losses in a row, so far
+        self._before = 0    # of the oldest in the window, how many are
+                            # from before the first we saw
+
+    def add(self, seq):
+        if self.top is None:
+            self._start(seq)
+            return
+
+        ahead = (seq - self.top) % _SEQ_MOD
+        if ahead and ahead < SEQ_RESYNC:
+            bits = self.bits << ahead
+            out = bits >> SEQ_WINDOW
+            if self._before:
+                # Nothing from before we started can have been lost
+                k = min(self._before, ahead)
+                out |= ((1 << k) - 1) << (ahead - k)
+                self._before -= k
+            self._drop(out, ahead)
+            self.bits = (bits & self._MASK) | 1
+            self.top = seq
+            return
+
+        behind = _SEQ_MOD - ahead if ahead else 0
+        if behind >= SEQ_RESYNC:
+            self._start(seq)
+        elif behind >= SEQ_WINDOW:
+            self.late += 1
+        elif self.bits >> behind & 1:
+            self.duplicates += 1
+        else:
+            self.reordered += 1
+            self.bits |= 1 << behind
+
+    def _start(self, seq):
+        self.top = seq
+        self.bits = 1
+        self._before = SEQ_WINDOW - 1
+        self._run = 0
+
+    def _drop(self, out, n):
+        """Count the losses among the n numbers that have just left the
+        window, whose bits are out, oldest highest"""
+        if out == (1 << n) - 1:
+            # All arrived
+            self._end_run()
+            return
+        for i in xrange(n - 1, max(0, n - SEQ_WINDOW) - 1, -1):
+            if out >> i & 1:
+                self._end_run()
+            else:
+                self.lost += 1
+                self._run += 1
+        if n > SEQ_WINDOW:
+            # The rest never even got into the window
+            self.lost += n - SEQ_WINDOW
+            self._run += n - SEQ_WINDOW
+
+    def _end_run(self):
+        if self._run > 1:
+            self.bursts += 1
+        self._run = 0
+
+
+class ClockStats(object):
+    """The last CLOCK_SAMPLES four-timestamp exchanges with a peer, as
+    NTP has them: t1 when we sent, t2 when it received, t3 when it
+    answered and t4 when we received the answer, t2 and t3 by its clock.
+
+    Each gives a delay, the round trip less the time the peer took, and
+    an offset, how far its clock is ahead of ours if the delay both ways
+    was the same. Queueing makes one way take longer than the other, so
+    the offset is taken from whichever of the last CLOCK_FILTER had the
+    least delay, as NTP's clock filter does.
+
+    One-way delays can't be known without knowing the offset, but how
+    much longer the latest took than the quickest in the ring can: the
+    offset cancels out. That is the queueing each way. The samples are
+    kept in seconds in one array of doubles, about 2KB a peer."""
+
+    __slots__ = ('samples', 'count', '_summary')
+
+    _N = 4      # delay, offset, t2 - t1, t4 - t3
+
+    def __init__(self):
+        self.samples = array.array('d', [0.0]) * (CLOCK_SAMPLES * self._N)
+        self.count = 0
+        self._summary = None
+
+    def add(self, t1, t2, t3, t4):
+        i = (self.count % CLOCK_SAMPLES) * self._N
+        (fwd, back) = (t2 - t1, t4 - t3)
+        self.samples[i:i + self._N] = array.array('d', (
+                (fwd + back) / 1e9,
+                (fwd - back) / 2e9,
+                fwd / 1e9,
+                back / 1e9))
+        self.count += 1
+        self._summary = None
+
+    def __len__(self):
+        return min(self.count, CLOCK_SAMPLES)
+
+    def summary(self):
+        """A dict of the filtered offset and the delay of the sample it
+        came from, the one-way delays of the latest exchange split by
+        that offset, and its queueing each way"""
+        if self._summary is None:
+            (s, N, n) = (self.samples, self._N, len(self))
+            if not n:
+                return dict.fromkeys(('offset', 'delay', 'forward',
+                        'backward', 'fwd_queue', 'back_queue'), 0.0)
+            last = ((self.count - 1) % CLOCK_SAMPLES) * N
+            recent = [((self.count - 1 - k) % CLOCK_SAMPLES) * N
+                    for k in xrange(min(n, CLOCK_FILTER))]
+            best = min(recent, key=s.__getitem__)
+            (delay, offset) = (s[best], s[best + 1])
+            self._summary = {
+                'offset': offset,
+                'delay': delay,
+                'forward': s[last + 2] - offset,
+                'backward': s[last + 3] + offset,
+                'fwd_queue': s[last + 2] - min(s[2:n * N:N]),
+                'back_queue': s[last + 3] - min(s[3:n * N:N]),
+            }
+        return self._summary
@@ -4,7 +4,7 @@
 # 
 """PTP TLV Protocol"""
 
-import struct, dpkt, exceptions, IPy, json
+import struct, dpkt, exceptions, IPy, json, socket
 import bson_wrapper, bson
 import sys
 
@@ -12,6 +12,7 @@ import sys
 PTP_VERSION         = 1
 PTP_MTU             = 1400
 PTP_BLOB_SIZE       = 1024
+PTP_TLV_MAX         = 255 - 2   # a TLV's length, header and all, is a byte
 
 
 # Protocol TLV types
@@ -24,12 +25,15 @@ PTP_TYPE_UUID       = 4
 
 PTP_TYPE_MYTS       = 8
 PTP_TYPE_YOURTS     = 9
+PTP_TYPE_RXTS       = 10
+PTP_TYPE_TXTS       = 11
 
 # Client-server
 PTP_TYPE_PTPADDR    = 32
 PTP_TYPE_INTADDR    = 33
 PTP_TYPE_UPNP       = 34
 PTP_TYPE_META       = 35
+PTP_TYPE_META_BSON  = 36
 PTP_TYPE_SHUTDOWN   = 45
 
 # Server-client
@@ -37,6 +41,11 @@ PTP_TYPE_CLIENTLIST_EXT = 64
 PTP_TYPE_CLIENTLEN      = 65
 PTP_TYPE_YOURADDR       = 66
 PTP_TYPE_CLIENTLIST_INT = 67
+PTP_TYPE_CLIENTGEN      = 68
+PTP_TYPE_CLIENTPAGE     = 69
+PTP_TYPE_CLIENTPAGES    = 70
+PTP_TYPE_CLIENTBASE     = 71
+PTP_TYPE_CLIENTDEL      = 72
 
 # Client-client
 PTP_TYPE_CC         = 96
@@ -50,19 +59,36 @@ PTP_NAMES = {
         PTP_TYPE_UUID: 'PTP_TYPE_UUID',
         PTP_TYPE_MYTS: 'PTP_TYPE_MYTS',
         PTP_TYPE_YOURTS: 'PTP_TYPE_YOURTS',
+        PTP_TYPE_RXTS: 'PTP_TYPE_RXTS',
+        PTP_TYPE_TXTS: 'PTP_TYPE_TXTS',
         PTP_TYPE_PTPADDR: 'PTP_TYPE_PTPADDR',
         PTP_TYPE_INTADDR: 'PTP_TYPE_INTADDR',
         PTP_TYPE_UPNP: 'PTP_TYPE_UPNP',
         PTP_TYPE_META: 'PTP_TYPE_META',
+        PTP_TYPE_META_BSON: 'PTP_TYPE_META_BSON',
         PTP_TYPE_SHUTDOWN: 'PTP_TYPE_SHUTDOWN',
         PTP_TYPE_CLIENTLIST_EXT: 'PTP_TYPE_CLIENTLIST_EXT',
         PTP_TYPE_CLIENTLEN: 'PTP_TYPE_CLIENTLEN',
         PTP_TYPE_YOURADDR: 'PTP_TYPE_YOURADDR',
         PTP_TYPE_CLIENTLIST_INT: 'PTP_TYPE_CLIENTLIST_INT',
+        PTP_TYPE_CLIENTGEN: 'PTP_TYPE_CLIENTGEN',
+        PTP_TYPE_CLIENTPAGE: 'PTP_TYPE_CLIENTPAGE',
+        PTP_TYPE_CLIENTPAGES: 'PTP_TYPE_CLIENTPAGES',
+        PTP_TYPE_CLIENTBASE: 'PTP_TYPE_CLIENTBASE',
+        PTP_TYPE_CLIENTDEL: 'PTP_TYPE_CLIENTDEL',
         PTP_TYPE_CC: 'PTP_TYPE_CC',
 }
 
 
+class DecodeError(exceptions.RuntimeError):
+    """Raised when a packet cannot be decoded"""
+    pass
+
+class ChecksumError(DecodeError):
+    """Raised when a packet fails its checksum"""
+    pass
+
+
 class Base(dpkt.Packet):
     __hdr__ = (
     )
@@ -194,17 +220,25 @@ PTP_MAP = {
 
         PTP_TYPE_MYTS: UInt,
         PTP_TYPE_YOURTS: UInt,
+        PTP_TYPE_RXTS: UInt,
+        PTP_TYPE_TXTS: UInt,
 
         PTP_TYPE_PTPADDR: Address,
         PTP_TYPE_INTADDR: Address,
         PTP_TYPE_UPNP: UInt,
         PTP_TYPE_META: JSON,
+        PTP_TYPE_META_BSON: BSON,
         PTP_TYPE_SHUTDOWN: UInt,
 
         PTP_TYPE_CLIENTLIST_EXT: Address,
         PTP_TYPE_CLIENTLEN: UInt,
         PTP_TYPE_YOURADDR: Address,
         PTP_TYPE_CLIENTLIST_INT: Address,
+        PTP_TYPE_CLIENTGEN: UInt,
+        PTP_TYPE_CLIENTPAGE: UInt,
+        PTP_TYPE_CLIENTPAGES: UInt,
+        PTP_TYPE_CLIENTBASE: UInt,
+        PTP_TYPE_CLIENTDEL: Address,
 
         PTP_TYPE_CC: String,
 }
@@ -258,13 +292,10 @@ class PTP(dpkt.Packet):
         # Unpack the header
         dpkt.Packet.unpack(self, buf)
 
-        # Now process the TLV's
-        buf = self.data
+        # Now process the TLV's, by offset rather than by re-slicing
         l = []
-        while buf:
-            tlv = TLV(buf)
-            l.append(tlv)
-            buf = buf[len(tlv):]
+        for (t, off, ln) in _walk(memoryview(buf), len(buf)):
+            l.append(TLV(buf[off - 2:off + ln]))
         self.data = l
 
     def __len__(self):
@@ -275,3 +306,221 @@ class PTP(dpkt.Packet):
         csum = dpkt.in_cksum(self.pack_hdr() + data)
         return self.pack_hdr() + data + struct.pack('!H', csum)
 
+
+
+#
+# Fast decoder.
+#
+# This walks a single memoryview by offset with precompiled structs and
+# returns plain (ptp_type, value) tuples; the values are the same as the
+# .data of the objects PTP() would build, without building any of them.
+#
+
+_CSUM = struct.Struct('!H')
+_UINT = {
+        1: struct.Struct('!B'),
+        2: struct.Struct('!H'),
+        4: struct.Struct('!I'),
+        8: struct.Struct('!Q'),
+}
+_INT = {
+        1: struct.Struct('!b'),
+        2: struct.Struct('!h'),
+        4: struct.Struct('!i'),
+        8: struct.Struct('!q'),
+}
+_PORT = struct.Struct('!H')
+
+def _cksum(mv, n):
+    """Same result as dpkt.in_cksum(buf[:n]), without the copy"""
+    cnt = n & ~1
+    s = sum(struct.unpack_from('<%dH' % (cnt >> 1), mv))
+    if cnt != n:
+        s += ord(mv[n - 1])
+    return dpkt.in_cksum_done(s)
+
+def _walk(mv, end):
+    """Validate the TLV stream in mv[1:end] and return a list of
+    (ptp_type, offset, length) for each value. No values are decoded
+    here so that junk is rejected before we do any real work."""
+    l = []
+    off = 1 # skip the version header
+    while off < end:
+        if off + 2 > end:
+            raise DecodeError("Truncated TLV header at offset %d" % off)
+        t = ord(mv[off])
+        ln = ord(mv[off + 1]) - 2
+        if t not in _DECODERS:
+            raise DecodeError("Unknown TLV type %d" % t)
+        off += 2
+        if ln < 0 or off + ln > end:
+            raise DecodeError("Truncated TLV type %d at offset %d" % (t, off))
+        l.append((t, off, ln))
+        off += ln
+    return l
+
+def _dec_uint(mv, off, ln):
+    try:
+        return _UINT[ln].unpack_from(mv, off)[0]
+    except KeyError:
+        raise DecodeError('Unknown unsigned integer size %d' % ln)
+
+def _dec_int(mv, off, ln):
+    try:
+        return _INT[ln].unpack_from(mv, off)[0]
+    except KeyError:
+        raise DecodeError('Unknown integer size %d' % ln)
+
+def _dec_string(mv, off, ln):
+    return mv[off:off + ln].tobytes()
+
+def _dec_address(mv, off, ln):
+    if ln == 6: # IPv4
+        return (socket.inet_ntoa(mv[off:off + 4].tobytes()),
+                _PORT.unpack_from(mv, off + 4)[0])
+    if ln == 18: # IPv6
+        return unpack_sin(mv[off:off + ln].tobytes())
+    raise DecodeError('Bad address length %d' % ln)
+
+def _dec_json(mv, off, ln):
+    return json.loads(mv[off:off + ln].tobytes())
+
+def _dec_bson(mv, off, ln):
+    return bson.loads(mv[off:off + ln].tobytes())
+
+_CLASS_DECODERS = {
+        UInt: _dec_uint,
+        Int: _dec_int,
+        String: _dec_string,
+        Address: _dec_address,
+        JSON: _dec_json,
+        BSON: _dec_bson,
+}
+
+_DECODERS = dict((t, _CLASS_DECODERS[cls]) for (t, cls) in PTP_MAP.items())
+
+# What the value decoders raise on a value they cannot make sense of;
+# bson's, in pure Python, fails on junk in whatever way it trips over it
+_VALUE_ERRORS = (ValueError, struct.error, socket.error,
+        IndexError, KeyError, TypeError, NameError)
+
+def decode(buf):
+    """Decode a packet into a list of (ptp_type, value) tuples.
+
+    Raises ChecksumError if the checksum is wrong and DecodeError if
+    the packet is otherwise malformed, has TLVs of an unknown type or
+    has a value that does not decode."""
+    end = len(buf) - 2
+    if end < 1:
+        raise DecodeError("Short packet of %d bytes" % len(buf))
+    mv = memoryview(buf)
+
+    csum = _CSUM.unpack_from(mv, end)[0]
+    if _cksum(mv, end) != csum:
+        raise ChecksumError("Bad checksum %d" % csum)
+
+    tlvs = _walk(mv, end)
+    dec = _DECODERS
+    try:
+        return [(t, dec[t](mv, off, ln)) for (t, off, ln) in tlvs]
+    except _VALUE_ERRORS, e:
+        # A value that is junk inside a sound TLV, such as bad JSON
+        raise DecodeError("Bad TLV value: %s" % e)
+
+
+#
+# Fast encoder.
+#
+# These build the wire form of single TLVs directly, so callers can
+# cache and join encoded segments rather than building TLV objects.
+#
+
+_TLVHDR = struct.Struct('!BB')
+_SIN4 = struct.Struct('!4sH')
+
+def encode_sin(sin):
+    """Same result as pack_sin(), with a fast path for IPv4"""
+    (addr, port) = sin
+    if ':' not in addr:
+        return _SIN4.pack(socket.inet_aton(addr), port)
+    return pack_sin(sin)
+
+def encode_uint(ptp_type, size, value):
+    return _TLVHDR.pack(ptp_type, size + 2) + _UINT[size].pack(int(value))
+
+def encode_string(ptp_type, value):
+    return _TLVHDR.pack(ptp_type, len(value) + 2) + value
+
+def encode_address(ptp_type, sin):
+    a = encode_sin(sin)
+    return _TLVHDR.pack(ptp_type, len(a) + 2) + a
+
+def encode(body):
+    """Wrap a string of encoded TLVs with the header and checksum"""
+    buf = chr(PTP_VERSION) + body
+    return buf + _CSUM.pack(dpkt.in_cksum(buf))
+
+
+
+_UINT_FMT = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+_CSUM_LE = struct.Struct('<H')
+
+
+class Template(object):
+    """A packet that is sent again and again with only some unsigned
+    integer TLVs, such as the sequence number and timestamp, changing.
+
+    It is described once, from parts that are either encoded TLVs or
+    (name, ptp_type, size) for a value to set() later, by one struct
+    covering the whole packet, and another reading it as the words
+    dpkt.in_cksum sums. set() only notes a value; packet() packs the
+    lot in one call and sums it in another, which is cheaper than
+    encoding the TLVs one by one.
+
+    packet() returns the packet to send, optionally with a tail of more
+    encoded TLVs. The length of a template is that of its TLVs, as for
+    the string encode() would wrap."""
+
+    def __init__(self, *parts):
+        super(Template, self).__init__()
+        fmt = ['!B']
+        self._args = [PTP_VERSION]
+        self._index = {}
+        off = 1
+        for part in parts:
+            if isinstance(part, tuple):
+                (name, ptp_type, size) = part
+                fmt.append('BB' + _UINT_FMT[size])
+                self._args += [ptp_type, size + 2, 0]
+                self._index[name] = len(self._args) - 1
+                off += 2 + size
+            else:
+                fmt.append('%ds' % len(part))
+                self._args.append(part)
+                off += len(part)
+        self._end = off
+        self._struct = struct.Struct(''.join(fmt))
+        # Little-endian words, as dpkt.in_cksum sums them; an odd byte
+        # at the end is added on its own
+        self._words = struct.Struct('<%dH' % (off >> 1))
+
+    def __len__(self):
+        return self._end - 1
+
+    def set(self, name, value):
+        self._args[self._index[name]] = int(value)
+
+    def packet(self, tail=''):
+        body = self._struct.pack(*self._args)
+        s = sum(self._words.unpack_from(body))
+        if self._end & 1:
+            s += ord(body[-1])
+            if tail:
+                # The tail starts with the high byte of our last word
+                s += (ord(tail[0]) << 8) + dpkt.in_cksum_add(0, tail[1:])
+        elif tail:
+            s += dpkt.in_cksum_add(0, tail)
+        # As dpkt.in_cksum_done() folds it; the words were little-endian
+        s = (s >> 16) + (s & 0xffff)
+        s += s >> 16
+        return ''.join((body, tail, _CSUM_LE.pack(~s & 0xffff)))
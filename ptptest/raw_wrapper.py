@@ -6,9 +6,9 @@
 Urwid extensions: Eventlet happy Raw display implementation
 """
 
-import eventlet, select, errno
+import select, errno
 from urwid import raw_display
-from eventlet.green import time
+from eventlet.green import select as green_select
 
 
 class RawScreen(raw_display.Screen):
@@ -29,34 +29,21 @@ class RawScreen(raw_display.Screen):
         super(RawScreen, self).signal_restore()
 
     def _wait_for_input_ready(self, timeout):
-        ready = None
-        p = select.poll()
-        p.register(self._term_input_file.fileno(), select.POLLIN)
-
+        # A look that cannot block, which is how urwid asks when the
+        # event loop has seen input, needs no help; anything longer
+        # waits on the hub instead of stopping every other greenlet
+        fd_list = []
+        fd = self._input_fileno()
+        if fd is not None:
+            fd_list.append(fd)
         if self.gpm_mev is not None:
-            p.register(self.gpm_mev.stdout.fileno(), select.POLLIN)
-
+            fd_list.append(self.gpm_mev.stdout.fileno())
+        wait = select.select if timeout == 0 else green_select.select
         while True:
             try:
-                if timeout is None:
-                    events = p.poll(0)
-                    if events is None or len(events) == 0:
-                        eventlet.sleep(0.1)
-                        continue
-                else:
-                    events = p.poll(timeout)
-                ready = []
-                for fd, event in events:
-                    if event == select.POLLIN:
-                        ready.append(fd)
-                break
-
+                return wait(fd_list, [], fd_list, timeout)[0]
             except select.error, e:
-                if e.args[0] != select.EINTR:
+                if e.args[0] != errno.EINTR:
                     raise
                 if self._resized:
-                    ready = []
-                    break
-
-        return ready
-
+                    return []
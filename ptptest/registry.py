@@ -0,0 +1,184 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+# Copyright (c) 2014 Chris Luke <chrisy@flirble.org>
+#
+"""Client registry shared between server processes"""
+
+import mmap, struct, exceptions
+from eventlet.green import socket
+
+# Default number of clients each worker can register
+REGISTRY_SIZE = 65536
+
+# Partition header: sequence lock, generation, slots in use
+_HDR = struct.Struct('=QQI4x')
+# Then the slots changed by the last CHANGE_LOG_SIZE generations
+CHANGE_LOG_SIZE = 1024
+_LOG = struct.Struct('=%dI' % CHANGE_LOG_SIZE)
+# Then the slots: in use, has internal address, external and internal address
+_SLOT = struct.Struct('=BB4sH4sH2x')
+_SLOTS = _HDR.size + _LOG.size
+
+_NOADDR = '\0' * 4
+_LOGENT = struct.Struct('=I')
+
+
+class RegistryFull(exceptions.RuntimeError):
+    """Raised when a worker has no room to register another client"""
+    pass
+
+
+class Registry(object):
+    """A table of client addresses in shared memory, split into one
+    partition per worker process.
+
+    Each worker writes only its own partition, so no locks are needed
+    between processes; a sequence count that is odd while a partition
+    is being written lets the others spot, and retry, a torn read. A
+    worker registers the clients it hears from with put() and drop(),
+    and collects the clients of the other workers with changes().
+
+    Create it before forking, so that the workers share the mapping,
+    then attach() each worker to its partition. Only IPv4 addresses
+    can be stored; an internal address that is not one is left out."""
+
+    def __init__(self, workers, size=REGISTRY_SIZE):
+        super(Registry, self).__init__()
+        self.workers = workers
+        self.size = size
+        self._part = _SLOTS + size * _SLOT.size
+        self._mm = mmap.mmap(-1, workers * self._part)
+        self.worker = None
+
+    def attach(self, worker):
+        """Make this process the writer of partition worker"""
+        self.worker = worker
+        self._base = worker * self._part
+        self._slot = {}     # key -> slot number
+        self._free = []     # slot numbers below _used not in use
+        self._used = 0
+        # Carry on from whatever was there before, so readers notice
+        (self._seq, self._gen, used) = _HDR.unpack_from(self._mm, self._base)
+        self._seen = {}     # worker -> (generation, {slot: (sin, ptpaddr)})
+
+    def _write(self, slot, data):
+        mm = self._mm
+        self._seq += 1
+        _HDR.pack_into(mm, self._base, self._seq, self._gen, self._used)
+        _SLOT.pack_into(mm, self._base + _SLOTS + slot * _SLOT.size, *data)
+        self._seq += 1
+        self._gen += 1
+        _LOGENT.pack_into(mm, self._base + _HDR.size +
+                (self._gen % CHANGE_LOG_SIZE) * _LOGENT.size, slot)
+        _HDR.pack_into(mm, self._base, self._seq, self._gen, self._used)
+
+    def put(self, k, client):
+        """Register (or update) a client of ours"""
+        slot = self._slot.get(k)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+            elif self._used < self.size:
+                slot = self._used
+                self._used += 1
+            else:
+                raise RegistryFull("No room for client %s" % repr(k))
+            self._slot[k] = slot
+
+        (addr, port) = client.sin[:2]
+        (intaddr, intport, hasint) = (_NOADDR, 0, 0)
+        if client.ptpaddr is not None and ':' not in client.ptpaddr[0]:
+            (intaddr, intport) = client.ptpaddr[:2]
+            intaddr = socket.inet_aton(intaddr)
+            hasint = 1
+        self._write(slot, (1, hasint, socket.inet_aton(addr), port, intaddr, intport))
+
+    def drop(self, k):
+        """Forget a client of ours"""
+        slot = self._slot.pop(k, None)
+        if slot is None:
+            return
+        self._free.append(slot)
+        self._write(slot, (0, 0, _NOADDR, 0, _NOADDR, 0))
+
+    def clear(self, worker):
+        """Empty the partition of a worker that has gone away"""
+        base = worker * self._part
+        (seq, gen, used) = _HDR.unpack_from(self._mm, base)
+        _HDR.pack_into(self._mm, base, seq + 1, gen, used)
+        self._mm[base + _SLOTS:base + self._part] = '\0' * (self._part - _SLOTS)
+        # Too big a change for the log to describe
+        _HDR.pack_into(self._mm, base, seq + 2, gen + CHANGE_LOG_SIZE + 1, 0)
+
+    def _read(self, worker, seen):
+        """Returns (generation, {slot: (sin, ptpaddr)}) of the slots of a
+        partition that changed after generation seen, or of all of them
+        if seen is None or too long ago; None if it is being written to"""
+        mm = self._mm
+        base = worker * self._part
+        (seq, gen, used) = _HDR.unpack_from(mm, base)
+        if seq & 1:
+            return None
+
+        if seen is not None and gen - seen <= CHANGE_LOG_SIZE:
+            log = _LOG.unpack_from(mm, base + _HDR.size)
+            changed = set(log[g % CHANGE_LOG_SIZE] for g in xrange(seen + 1, gen + 1))
+            data = [(slot, _SLOT.unpack_from(mm, base + _SLOTS + slot * _SLOT.size))
+                    for slot in changed]
+        else:
+            blob = mm[base + _SLOTS:base + _SLOTS + used * _SLOT.size]
+            data = enumerate(_SLOT.unpack_from(blob, off)
+                    for off in xrange(0, len(blob), _SLOT.size))
+
+        if _HDR.unpack_from(mm, base)[0] != seq:
+            return None
+
+        slots = {}
+        for (slot, (inuse, hasint, addr, port, intaddr, intport)) in data:
+            if not inuse:
+                slots[slot] = None
+                continue
+            ptpaddr = (socket.inet_ntoa(intaddr), intport) if hasint else None
+            slots[slot] = ((socket.inet_ntoa(addr), port), ptpaddr)
+        return (gen, slots)
+
+    def changes(self):
+        """Returns two lists, of the (sin, ptpaddr) of clients of the
+        other workers that were added or changed, and the sin of those
+        that went, since we last asked. A partition that is being
+        written to is left until next time."""
+        added = {}
+        removed = set()
+        for worker in xrange(self.workers):
+            if worker == self.worker:
+                continue
+            (seen, table) = self._seen.get(worker, (None, {}))
+            gen = _HDR.unpack_from(self._mm, worker * self._part)[1]
+            if gen == seen:
+                continue
+            part = self._read(worker, seen)
+            if part is None:
+                continue
+            (gen, slots) = part
+
+            if seen is None or gen - seen > CHANGE_LOG_SIZE:
+                # Everything not in the partition now has gone
+                for slot in table.keys():
+                    if slot not in slots:
+                        slots[slot] = None
+
+            for (slot, entry) in slots.iteritems():
+                old = table.get(slot)
+                if old == entry:
+                    continue
+                if old is not None:
+                    removed.add(old[0])
+                    del(table[slot])
+                if entry is not None:
+                    table[slot] = entry
+                    added[entry[0]] = entry[1]
+            self._seen[worker] = (gen, table)
+
+        # A client that moved slots has not gone
+        removed.difference_update(added)
+        return (added.items(), list(removed))
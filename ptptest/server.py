@@ -8,23 +8,50 @@ if sys.platform == 'win32':
     import win32hacks
     win32hacks.install_hacks()
 
-import eventlet, eventlet.debug
+import eventlet, eventlet.debug, eventlet.event, eventlet.hubs, eventlet.queue
 
 # Don't patch 'os' because it breaks nonblocking os.read
 eventlet.monkey_patch(socket=True, os=False, time=True)
 eventlet.debug.hub_prevent_multiple_readers(False)
-eventlet.debug.hub_blocking_detection(True)
 
 from eventlet.green import socket
 from eventlet.green import time
+import collections, errno, os, signal, traceback
 
 import __init__ as ptptest
-import protocol, hexdump, uuid, ui
+import protocol, hexdump, uuid, events, beacon, wheel, pacing, mmsg, peer, registry, clock, capture
 
-PTP_SERVERVER       = 2
+PTP_SERVERVER       = 6
 
-def _mkey(addr, port):
-    return "%s-%d" % (addr, port)
+# Seconds without hearing from a client before we forget it
+CLIENT_TIMEOUT      = 30
+
+# Seconds between looking for clients to expire
+EXPIRE_INTERVAL     = 1
+
+# Seconds between the beacons to each client, and the least time between
+# the extra rounds of beacons sent when clients come and go
+BEACON_INTERVAL     = 13
+FLUSH_INTERVAL      = 1
+
+# Default ceiling on beacon packets per second
+BEACON_PPS          = 1000
+
+# Successive client phases are this fraction of BEACON_INTERVAL apart,
+# which spreads them evenly however many there are
+_PHASE_STEP         = 0.6180339887
+
+# Clients from these versions on understand a paginated client list,
+# deltas to it, and our times in the answers to their timestamps
+PTP_PAGED_CLIENTVER = 3
+PTP_DELTA_CLIENTVER = 4
+PTP_NTP_CLIENTVER   = 5
+
+_SERVERVER_TLV = protocol.encode_uint(protocol.PTP_TYPE_SERVERVER, 1, PTP_SERVERVER)
+
+# Version, checksum and CLIENTLEN; then CLIENTGEN, CLIENTPAGE and CLIENTPAGES
+_OVERHEAD           = 1 + 2 + 3
+_PAGE_OVERHEAD      = 6 + 4 + 4
 
 
 class Server(object):
@@ -35,231 +62,528 @@ class Server(object):
     port = None
 
     clients = {}
-    server_seq = 0
+    events = None
     ui = None
     stun = None
+    worker = 0
 
     _clock = eventlet.semaphore.Semaphore()
 
-    def __init__(self, args):
+    def __init__(self, args, shared=None, worker=0):
         super(Server, self).__init__()
         self.args = args
-
-        if 'stun' in args and args.stun:
+        self.worker = worker
+        if getattr(args, 'hub', None):
+            # Before anything is waiting on the hub we'd be replacing
+            eventlet.hubs.use_hub(args.hub)
+        self.events = events.Events(level=events.DEBUG if args.debug else events.INFO,
+                sample=getattr(args, 'debugsample', 1))
+
+        if 'stun' in args and args.stun and not worker:
             import stunloop
             self.stun = stunloop.Stun()
 
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if shared is not None:
+            # The kernel spreads clients over the workers bound here
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         if self.args.debug: print "Binding server to %s port %d" % (args.server, args.port)
         s.bind((args.server, args.port))
         (self.addr, self.port) = s.getsockname()
         self.sock = s
+        self.io = mmsg.datagram_io(s, protocol.PTP_MTU, batched=getattr(args, 'mmsg', True),
+                timestamps=getattr(args, 'kernelts', False), events=self.events)
+        self._capture = None
 
         self.clients = {}
-
-    def _client_parse(self, buf, sin, client):
-        l = protocol.PTP(buf)
-        if l is None:
-            self.ui.log("Client packet from %s failed to parse!" % repr(sin))
+        self._registry = shared
+        self._remote = {}   # clients of the other workers
+        self._beacon = beacon.BeaconCache()
+        self._expiry = wheel.TimerWheel()
+
+        pps = BEACON_PPS
+        if 'pps' in args and args.pps:
+            pps = args.pps
+        self._pacer = pacing.TokenBucket(pps)
+        self._schedule = pacing.Schedule()
+        self._phase = 0.0
+        self._flush = False
+        self._flush_ts = 0
+        self._wakeup = eventlet.queue.LightQueue()
+        self._sent = 0
+        self._stopped = eventlet.event.Event()
+
+    def _client_parse(self, buf, sin, client, rx=None, trace=False):
+        (now, rx_mono) = (clock.realtime_ns(), clock.monotonic_ns())
+        if rx is None:
+            rx = now
+        else:
+            # Then it arrived this much earlier by the monotonic clock too
+            delay = max(0, now - rx)
+            rx_mono -= delay
+            client.add_rx_delay(delay / 1e9)
+        try:
+            l = protocol.decode(buf)
+        except protocol.ChecksumError, e:
+            self.events.warning("Client packet from %r has a bad checksum! %s", sin, e)
             return False
-        if l.buf_csum is None or l.buf_csum != l.csum:
-            self.ui.log("Client packet from %s has a bad checksum! %d %d" % (repr(sin), l.buf_csum, l.csum))
+        except protocol.DecodeError, e:
+            self.events.warning("Client packet from %r failed to parse! %s", sin, e)
             return False
 
-        client['ts'] = time.time()
-        client['stats']['rcvd'] += 1
-
-        if self.args.debug: self.ui.log(repr(l), indent='  ')
-
-        for tlv in l.data:
-            p = tlv.data
-            if p.ptp_type == protocol.PTP_TYPE_CLIENTVER:
-                client['clientver'] = p.data
-            elif p.ptp_type == protocol.PTP_TYPE_SEQUENCE:
-                client['sequence'] = p.data
-            elif p.ptp_type == protocol.PTP_TYPE_UUID:
-                client['uuid'] = p.data
-            elif p.ptp_type == protocol.PTP_TYPE_MYTS:
-                self._client_respond(client, p.data)
-                client['myts'] = float(p.data) / float(2**32)
-            elif p.ptp_type == protocol.PTP_TYPE_PTPADDR:
-                client['ptpaddr'] = p.data
-            elif p.ptp_type == protocol.PTP_TYPE_YOURTS:
-                ts = float(p.data) / float(2**32)
-                rtt = client['ts'] - ts
-                client['stats']['rtt'] = rtt
-                client['stats']['ackd'] += 1
-                self.ui.log("ACK from client %s; RTT %fs" % (str(sin), rtt))
-            elif p.ptp_type == protocol.PTP_TYPE_SHUTDOWN:
+        client.ts = rx / 1e9
+        client.rcvd += 1
+        self._expiry.schedule(sin, client.ts + CLIENT_TIMEOUT)
+
+        if trace:
+            self.events.debug("%r", events.Lazy(protocol.PTP, buf), indent='  ')
+
+        their_ts = your_ts = rxts = txts = None
+        for (ptp_type, data) in l:
+            if ptp_type == protocol.PTP_TYPE_CLIENTVER:
+                if data != client.clientver:
+                    client.clientver = data
+                    client.echo = None # what goes in depends on it
+            elif ptp_type == protocol.PTP_TYPE_SEQUENCE:
+                client.sequence = data
+                client.seen(data)
+            elif ptp_type == protocol.PTP_TYPE_UUID:
+                if data != client.uuid:
+                    client.uuid = data
+                    # Our templates for it have its UUID in
+                    client.beacon = client.echo = None
+            elif ptp_type == protocol.PTP_TYPE_CLIENTGEN:
+                client.gen = data
+            elif ptp_type == protocol.PTP_TYPE_MYTS:
+                their_ts = data
+            elif ptp_type == protocol.PTP_TYPE_PTPADDR:
+                client.ptpaddr = data
+                self._register(sin, client)
+            elif ptp_type == protocol.PTP_TYPE_YOURTS:
+                your_ts = data
+            elif ptp_type == protocol.PTP_TYPE_RXTS:
+                rxts = data
+            elif ptp_type == protocol.PTP_TYPE_TXTS:
+                txts = data
+            elif ptp_type == protocol.PTP_TYPE_SHUTDOWN:
                 # Client is going away!
                 return False
-            elif p.ptp_type == protocol.PTP_TYPE_META:
-                meta = p.data
-                self.ui.log("Meta received: '%s'" % repr(meta))
+            elif ptp_type in (protocol.PTP_TYPE_META, protocol.PTP_TYPE_META_BSON):
+                meta = data
+                self.events.log("Meta received: '%r'", meta)
 
-        self.ui.peer_update('client', client['sin'], client['stats'])
+        if their_ts is not None:
+            self._client_respond(client, their_ts, rx)
+        if your_ts is not None:
+            rtt = client.add_exchange(your_ts, rx_mono, rx, rxts, txts)
+            client.ackd += 1
+            self.events.log("ACK from client %s; RTT %fs", sin, rtt)
 
-        return True
+        self.events.peer_update('client', client)
 
-    def _client_respond(self, client, their_ts):
-        l = protocol.PTP(data=[])
-        l.data = []
-        t = protocol.TLV(type=protocol.PTP_TYPE_SERVERVER, data=protocol.UInt(size=1, data=PTP_SERVERVER))
-        l.data.append(t)
-        t = protocol.TLV(type=protocol.PTP_TYPE_SEQUENCE, data=protocol.UInt(size=4, data=self.server_seq))
-        l.data.append(t)
-        t = protocol.TLV(type=protocol.PTP_TYPE_UUID, data=protocol.String(data=client['uuid']))
-        l.data.append(t)
-        t = protocol.TLV(type=protocol.PTP_TYPE_YOURTS, data=protocol.UInt(size=8, data=their_ts))
-        l.data.append(t)
-
-        packet = l.pack()
-        if len(packet) > protocol.PTP_MTU: # bad
-            self.ui.log("Ignoring attempt to send ts %d bytes to client %s. MTU is %d" % \
-                    (len(packet), str(client['sin']), protocol.PTP_MTU))
-            return
+        return True
 
-        if self.args.debug:
-            self.ui.log("Sending ts %d bytes to client %s" % (len(packet), str(client['sin'])))
-            self.ui.log("%s" % repr(protocol.PTP(packet)), indent='  ')
+    def _register(self, k, client):
+        self._beacon.update(k, client)
+        if self._registry is not None:
+            try:
+                self._registry.put(k, client)
+            except registry.RegistryFull, e:
+                self.events.warning("Other workers will not see client %r! %s", k, e)
+
+    def _unregister(self, k):
+        self._beacon.remove(k)
+        if self._registry is not None:
+            self._registry.drop(k)
+
+    def _sync_registry(self):
+        """Bring the clients of the other workers into our beacons"""
+        (added, removed) = self._registry.changes()
+        for sin in removed:
+            self._remote.pop(sin, None)
+            self._beacon.remove(sin)
+        for (sin, ptpaddr) in added:
+            client = self._remote.get(sin)
+            if client is None:
+                client = self._remote[sin] = peer.Peer(sin)
+            client.ptpaddr = ptpaddr
+            self._beacon.update(sin, client)
+        if added or removed:
+            self._request_flush()
+
+    def _client_respond(self, client, their_ts, rx):
+        """Answer a client's timestamp, with when we got it (rx) and,
+        if it understands them, when we answered, by our realtime clock"""
+        ntp = client.clientver >= PTP_NTP_CLIENTVER
+        if client.echo is None:
+            parts = [
+                _SERVERVER_TLV,
+                ('seq', protocol.PTP_TYPE_SEQUENCE, 4),
+                protocol.encode_string(protocol.PTP_TYPE_UUID, client.uuid or ''),
+                ('ts', protocol.PTP_TYPE_YOURTS, 8),
+            ]
+            if ntp:
+                parts += [('rx', protocol.PTP_TYPE_RXTS, 8), ('tx', protocol.PTP_TYPE_TXTS, 8)]
+            client.echo = protocol.Template(*parts)
+        client.echo.set('seq', client.myseq)
+        client.echo.set('ts', their_ts)
+        if ntp:
+            client.echo.set('rx', rx)
+            client.echo.set('tx', clock.realtime_ns())
+        packet = client.echo.packet()
+
+        if self.events.sampled(events.DEBUG):
+            self.events.debug("Sending ts %d bytes to client %s", len(packet), client.sin)
+            self.events.debug("%r", events.Lazy(protocol.PTP, packet), indent='  ')
             if self.args.hexdump:
-                self.ui.log(hexdump.hexdump(result='return', data=packet))
-
-        self.sock.sendto(packet, client['sin'])
-        self.server_seq += 1L
-
-    def _client_beacons(self):
-        with self._clock:
-            for k in self.clients:
-                self._client_beacon(k, self.clients[k])
+                self.events.debug("%s", events.Lazy(hexdump.hexdump, packet, 'return'))
+
+        self.io.sendto(packet, client.sin)
+        client.myseq += 1
+
+    def _beacon_header(self, client):
+        """The client's beacon template, with our sequence number and
+        the time filled in; the rest of the beacon goes on the end"""
+        if client.beacon is None:
+            client.beacon = protocol.Template(
+                _SERVERVER_TLV,
+                ('seq', protocol.PTP_TYPE_SEQUENCE, 4),
+                protocol.encode_string(protocol.PTP_TYPE_UUID, client.uuid or ''),
+                ('ts', protocol.PTP_TYPE_MYTS, 8),
+                protocol.encode_address(protocol.PTP_TYPE_YOURADDR, client.sin))
+        client.beacon.set('seq', client.myseq)
+        client.beacon.set('ts', clock.monotonic_ns())
+        return client.beacon
 
     def _client_beacon(self, k, client):
-        # We need a list of TLVs and then form a PTP fron them
-        l = protocol.PTP(data=[])
-        l.data = []
-
-        t = protocol.TLV(type=protocol.PTP_TYPE_SERVERVER, data=protocol.UInt(size=1, data=PTP_SERVERVER))
-        l.data.append(t)
-        t = protocol.TLV(type=protocol.PTP_TYPE_SEQUENCE, data=protocol.UInt(size=4, data=self.server_seq))
-        l.data.append(t)
-        t = protocol.TLV(type=protocol.PTP_TYPE_UUID, data=protocol.String(data=client['uuid']))
-        l.data.append(t)
-        t = protocol.TLV(type=protocol.PTP_TYPE_MYTS, data=protocol.UInt(size=8, data=int(time.time()*2**32)))
-        l.data.append(t)
-        t = protocol.TLV(type=protocol.PTP_TYPE_YOURADDR, data=protocol.Address(data=client['sin']))
-        l.data.append(t)
-
-        # Now add the list of known clients
-        count = 0
-        for sk in self.clients:
-            if sk == k: continue  # skip the client we're sending this to
-            sc = self.clients[sk]
-            t = protocol.TLV(type=protocol.PTP_TYPE_CLIENTLIST_EXT,
-                    data=protocol.Address(data=sc['sin']))
-            l.data.append(t)
-            count += 1
-
-            # If this client address matches the address we're sending this packet to then we
-            # also send its local address - the clients can then try to talk locally
-            if sc['sin'][0] == client['sin'][0]:
-                t = protocol.TLV(type=protocol.PTP_TYPE_CLIENTLIST_INT,
-                        data=protocol.Address(data=sc['ptpaddr']))
-                l.data.append(t)
-
-        t = protocol.TLV(type=protocol.PTP_TYPE_CLIENTLEN, data=protocol.UInt(size=1, data=count))
-        l.data.append(t)
-
-        packet = l.pack()
-        if len(packet) > protocol.PTP_MTU: # bad
-            self.ui.log("Ignoring attempt to send %d bytes to client %s. MTU is %d" % \
-                    (len(packet), str(client['sin']), protocol.PTP_MTU))
+        header = self._beacon_header(client)
+        clientver = client.clientver
+
+        if clientver >= PTP_DELTA_CLIENTVER and client.gen:
+            # Just send what changed since the list the client has
+            if self._client_beacon_delta(k, client, header):
+                return
+
+        # The client list comes from the cache; only the header TLVs
+        # are specific to this packet
+        (count, clientlist) = self._beacon.clientlist(k, client)
+
+        gen = ''
+        if clientver >= PTP_PAGED_CLIENTVER:
+            gen = protocol.encode_uint(protocol.PTP_TYPE_CLIENTGEN, 4,
+                    self._beacon.generation)
+
+        size = _OVERHEAD + len(header) + len(gen) + len(clientlist)
+        if size > protocol.PTP_MTU:
+            if clientver >= PTP_PAGED_CLIENTVER:
+                # Too big for one packet, so send it in pages
+                self._client_beacon_pages(k, client, header)
+                return
+
+            # bad
+            self.events.warning("Ignoring attempt to send %d bytes to client %s. MTU is %d",
+                    size, client.sin, protocol.PTP_MTU)
             return
 
-        if self.args.debug:
-            self.ui.log("Sending %d bytes to client %s" % (len(packet), str(client['sin'])))
-            self.ui.log("%s" % repr(protocol.PTP(packet)), indent='  ')
+        packet = header.packet(''.join((
+            gen,
+            clientlist,
+            protocol.encode_uint(protocol.PTP_TYPE_CLIENTLEN, 1, count),
+        )))
+        self._send_beacon(client, packet)
+
+    def _client_beacon_delta(self, k, client, header):
+        delta = self._beacon.delta(k, client, client.gen)
+        if delta is None:
+            return False
+        (count, clientlist) = delta
+
+        body = ''.join((
+            protocol.encode_uint(protocol.PTP_TYPE_CLIENTGEN, 4, self._beacon.generation),
+            protocol.encode_uint(protocol.PTP_TYPE_CLIENTBASE, 4, client.gen),
+            clientlist,
+        ))
+        if _OVERHEAD + len(header) + len(body) > protocol.PTP_MTU:
+            return False # Easier to send the whole list
+
+        packet = header.packet(body +
+            protocol.encode_uint(protocol.PTP_TYPE_CLIENTLEN, 1, count))
+        self._send_beacon(client, packet)
+        return True
+
+    def _client_beacon_pages(self, k, client, header):
+        gen = protocol.encode_uint(protocol.PTP_TYPE_CLIENTGEN, 4, self._beacon.generation)
+        size = protocol.PTP_MTU - _OVERHEAD - _PAGE_OVERHEAD - len(header)
+        pages = self._beacon.pages(k, client, size)
+
+        for (index, (count, clientlist)) in enumerate(pages):
+            body = ''.join((
+                gen,
+                protocol.encode_uint(protocol.PTP_TYPE_CLIENTPAGE, 2, index),
+                protocol.encode_uint(protocol.PTP_TYPE_CLIENTPAGES, 2, len(pages)),
+                clientlist,
+                protocol.encode_uint(protocol.PTP_TYPE_CLIENTLEN, 1, count),
+            ))
+            if index:
+                # Only the first page carries a timestamp to be echoed
+                packet = protocol.encode(''.join((
+                    _SERVERVER_TLV,
+                    protocol.encode_uint(protocol.PTP_TYPE_SEQUENCE, 4, client.myseq),
+                    protocol.encode_string(protocol.PTP_TYPE_UUID, client.uuid or ''),
+                    protocol.encode_address(protocol.PTP_TYPE_YOURADDR, client.sin),
+                    body,
+                )))
+            else:
+                packet = header.packet(body)
+            self._send_beacon(client, packet)
+
+    def _send_beacon(self, client, packet):
+        if self.events.sampled(events.DEBUG):
+            self.events.debug("Sending %d bytes to client %s", len(packet), client.sin)
+            self.events.debug("%r", events.Lazy(protocol.PTP, packet), indent='  ')
             if self.args.hexdump:
-                self.ui.log(hexdump.hexdump(result='return', data=packet))
+                self.events.debug("%s", events.Lazy(hexdump.hexdump, packet, 'return'))
+
+        self.io.sendto(packet, client.sin)
+        client.sent += 1
+        client.myseq += 1
+        self._sent += 1
+        self.events.peer_update('client', client)
+
+    def _client_schedule(self, k):
+        # Give each client its own phase in the beacon interval
+        self._phase = (self._phase + _PHASE_STEP) % 1.0
+        self._schedule.schedule(k, time.time() + self._phase * BEACON_INTERVAL)
+
+    def _request_flush(self):
+        """Ask for a round of beacons to everyone, to tell them about
+        clients that came or went. Requests are coalesced."""
+        if not self._flush:
+            self._flush = True
+            self._wakeup.put(None)
+
+    def _beacon_loop(self):
+        """Sends each client its beacon at its own phase in the beacon
+        interval, plus any flushes, no faster than the pacer allows."""
+        queue = collections.deque()
+        queued = set()
 
-        self.sock.sendto(packet, client['sin'])
-        client['stats']['sent'] += 1
-        self.server_seq += 1L
-        self.ui.peer_update('client', client['sin'], client['stats'])
+        while self.running:
+            now = time.time()
+            keys = []
+            with self._clock:
+                if self._flush and now >= self._flush_ts + FLUSH_INTERVAL:
+                    self._flush = False
+                    self._flush_ts = now
+                    keys.extend(self.clients.keys())
+                for (k, deadline) in self._schedule.expire(now):
+                    if k not in self.clients:
+                        continue
+                    self._schedule.schedule(k, max(deadline + BEACON_INTERVAL, now))
+                    keys.append(k)
+            for k in keys:
+                if k not in queued:
+                    queued.add(k)
+                    queue.append(k)
+
+            if queue:
+                timeout = self._pacer.delay()
+                if timeout <= 0:
+                    # Send as many as we're allowed in one go
+                    with self.io.batch():
+                        while queue and self._pacer.delay() <= 0:
+                            k = queue.popleft()
+                            queued.discard(k)
+                            with self._clock:
+                                if k in self.clients:
+                                    sent = self._sent
+                                    self._client_beacon(k, self.clients[k])
+                                    self._pacer.consume(self._sent - sent)
+                    eventlet.sleep(0)
+                    continue
+            else:
+                timeout = self._schedule.next()
+                if timeout is not None:
+                    timeout = max(0, timeout - now)
+                if self._flush:
+                    flush = max(0, self._flush_ts + FLUSH_INTERVAL - now)
+                    timeout = flush if timeout is None else min(timeout, flush)
+
+            try:
+                self._wakeup.get(timeout=timeout)
+            except eventlet.queue.Empty:
+                pass
 
     def _read_loop(self):
         while self.running:
-            (buf, sin) = self.sock.recvfrom(protocol.PTP_MTU)
-            if self.args.debug: self.ui.log("%d bytes received from %s:%d" % (len(buf), sin[0], sin[1]))
-            k = _mkey(sin[0], sin[1])
-
-            send_beacons = False
-
-            # Client we know about?
-            with self._clock:
-                if k in self.clients:
-                    self.ui.log("Received packet from a known client %s" % repr(sin))
-                else:
-                    self.ui.log("Received packet from a new client %s" % repr(sin))
-                    self.clients[k] = {
-                            'sin': sin,
-                            'stats': {
-                                'sent': 0,
-                                'rcvd': 0,
-                                'ackd': 0,
-                                'rtt': 0,
-                            },
-                    }
-                    self.ui.peer_add(group='client', sin=sin)
-                    send_beacons = True
-
-                ret = self._client_parse(buf, sin, self.clients[k])
-                if ret == False:
-                    # Client should be removed
-                    self.ui.log("Immediately removing client %s" % repr(sin))
-                    self.ui.peer_del(group='client', sin=self.clients[k]['sin'])
-                    del(self.clients[k])
-                    send_beacons = True
-
-            if send_beacons: # send an immediate update
-                self._client_beacons()
+            packets = self.io.recv()
+            with self.io.batch():
+                for (buf, sin, rx) in packets:
+                    self._read(buf, sin, rx)
+            # Let others run, even when there's always more to read
+            eventlet.sleep(0)
+
+    def _read(self, buf, sin, rx=None):
+        # Debugging output for this packet, or not, all of it
+        trace = self.events.sampled(events.DEBUG)
+        if trace:
+            self.events.debug("%d bytes received from %s:%d", len(buf), sin[0], sin[1])
+        k = sin
+
+        send_beacons = False
+
+        # Client we know about?
+        with self._clock:
+            if k in self.clients:
+                if trace:
+                    self.events.debug("Received packet from a known client %r", sin)
+            else:
+                self.events.log("Received packet from a new client %r", sin)
+                self.clients[k] = peer.Peer(sin)
+                self._register(k, self.clients[k])
+                self._client_schedule(k)
+                self.events.peer_add('client', self.clients[k])
+                send_beacons = True
+
+            ret = self._client_parse(buf, sin, self.clients[k], rx, trace)
+            if ret == False:
+                # Client should be removed
+                self.events.log("Immediately removing client %r", sin)
+                self.events.peer_del('client', self.clients[k])
+                self._unregister(k)
+                self._expiry.cancel(k)
+                self._schedule.cancel(k)
+                del(self.clients[k])
+                send_beacons = True
+
+        if send_beacons: # send an update soon
+            self._request_flush()
 
     def run(self):
-        # Spawn a UI
-        self.ui = ui.UI(server=True, parent=self, force_curses=self.args.curses,
-            log_lines=self.args.log_lines)
-
-        self.ui.title("PTP Server version %s (protocol version %d)" %
+        if getattr(self.args, 'blockcheck', False):
+            eventlet.debug.hub_blocking_detection(True)
+
+        if getattr(self.args, 'headless', False):
+            prefix = ''
+            if self._registry is not None:
+                prefix = "[%d] " % self.worker
+            self.events.subscribe(events.Printer(prefix=prefix))
+            events.handle_signals(self)
+        elif not self.worker:
+            # Spawn a UI; only the first worker gets one
+            import ui
+            self.ui = ui.UI(server=True, parent=self, force_curses=self.args.curses,
+                log_lines=self.args.log_lines, fps=getattr(self.args, 'fps', None))
+            self.events.subscribe(self.ui)
+        if getattr(self.args, 'logfile', None):
+            path = self.args.logfile
+            if self._registry is not None:
+                path = "%s-%d" % (path, self.worker)
+            self.events.subscribe(events.FileLog(path))
+        if getattr(self.args, 'capture', None):
+            path = self.args.capture
+            if self._registry is not None:
+                path = "%s-%d" % (path, self.worker)
+            self._start_capture(path)
+
+        self.events.title("PTP Server version %s (protocol version %d)" %
                 (ptptest.__version__, PTP_SERVERVER), stdout=True)
-        self.ui.log("Our socket is %s %s" % (self.addr, self.port), stdout=True)
-        self.ui.set_address(self.addr, self.port)
+        if self._registry is not None:
+            self.events.log("Worker %d of %d; only its own clients are listed here",
+                    self.worker + 1, self._registry.workers, stdout=True)
+        self.events.log("Our socket is %s %s", self.addr, self.port, stdout=True)
+        if getattr(self.args, 'kernelts', False) and not self.io.timestamps:
+            self.events.warning("Kernel timestamps need recvmmsg, which we aren't using")
+        self.events.set_address(self.addr, self.port)
 
         eventlet.spawn(self._read_loop)
+        eventlet.spawn(self._beacon_loop)
 
         if self.stun:
-            self.stun.set_ui(self.ui)
+            self.stun.set_ui(self.events)
             eventlet.spawn(self.stun.run)
 
-        client_ts = 0
-        while self.running:
-            ts = time.time()
-            if ts - client_ts > 13:
-                client_ts = ts
-                # Send our beacons to the clients
-                self._client_beacons()
+        expire = pacing.Periodic(EXPIRE_INTERVAL, self._expire)
+        expire.start(EXPIRE_INTERVAL)
 
-            # See if any clients need to be expired
-            with self._clock:
-                remove = []
-                for k in self.clients:
-                    client = self.clients[k]
-                    if 'ts' not in client or client['ts'] + 30 < ts:
-                        remove.append(k)
-                for k in remove:
-                    self.ui.log("Expiring client %s" % k)
-                    self.ui.peer_del(group='client', sin=self.clients[k]['sin'])
-                    del(self.clients[k])
-
-            # Wait a moment
-            eventlet.sleep(1)
+        # Everything else happens on the hub; wait here until stopped
+        self._stopped.wait()
+        expire.stop()
+        if self._capture is not None:
+            self._capture.close()
+
+    def _expire(self):
+        ts = time.time()
 
+        # See if any clients need to be expired; the wheel only
+        # gives us those that are due
+        with self._clock:
+            if self._registry is not None:
+                self._sync_registry()
+            for k in self._expiry.expire(ts):
+                if k not in self.clients:
+                    continue
+                self.events.log("Expiring client %r", k)
+                self.events.peer_del('client', self.clients[k])
+                self._unregister(k)
+                self._schedule.cancel(k)
+                del(self.clients[k])
+
+    def _start_capture(self, path):
+        args = self.args
+        # What the socket is bound to, so that with INADDR_ANY each
+        # peer gets our address towards it
+        self._capture = capture.Capture(path, self.sock.getsockname(),
+                size=args.capturesize * 1024 * 1024, count=args.capturefiles,
+                interval=args.capturetime or None, events=self.events)
+        self.io = capture.CaptureIO(self.io, self._capture)
+
+    def stop(self):
+        """Ask run() to return"""
+        self.running = False
+        if not self._stopped.ready():
+            self._stopped.send()
+
+
+def run_workers(args):
+    """Run args.workers servers, each in its own process, all bound to
+    the same port and sharing their clients through a Registry. The
+    first worker has the UI; when any worker stops, they all do."""
+    shared = registry.Registry(args.workers)
+    pids = {}
+    for worker in xrange(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            # Start afresh with our own hub, not a copy of the parent's
+            eventlet.hubs.use_hub()
+            if worker:
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+            shared.attach(worker)
+            status = 0
+            try:
+                Server(args, shared, worker).run()
+            except:
+                traceback.print_exc()
+                status = 1
+            os._exit(status)
+        pids[pid] = worker
+
+    # Leave ^C to the workers, and pass on anything asking us to stop
+    def terminate(signum, frame):
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, terminate)
+    while pids:
+        try:
+            (pid, status) = os.wait()
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if pid not in pids:
+            continue
+        shared.clear(pids.pop(pid))
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
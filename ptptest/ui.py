@@ -6,9 +6,203 @@
 UI
 """
 
-import eventlet, urwid, sys, signal
+import eventlet, urwid, sys, signal, bisect, re, collections
+from eventlet.green import time
 from urwid_eventlet import EventletEventLoop
 
+# Default ceiling on screen updates a second
+FRAME_RATE          = 1
+
+# How many rows the peer table keeps widgets for; more than fit on any
+# screen, so scrolling about doesn't keep building them
+ROW_CACHE           = 256
+
+# What the peer table can be sorted by, each the key of a row, worst
+# first; the address breaks ties
+SORTS = (
+    ('address', lambda peer: 0),
+    ('RTT', lambda peer: -peer.rtt_mean),
+    ('loss', lambda peer: -peer.lost),
+)
+
+# Filters typed at the / prompt: "rtt>0.01", "loss>0", or otherwise a
+# piece of the address
+_FILTER = re.compile(r'^\s*(rtt|loss)\s*>\s*([0-9.]+)\s*$', re.I)
+
+
+def _row_filter(text):
+    """A function of a peer saying whether it passes filter text"""
+    m = _FILTER.match(text)
+    if m is None:
+        return lambda peer: text in "%s:%d" % peer.sin[:2]
+    limit = float(m.group(2))
+    if m.group(1).lower() == 'rtt':
+        return lambda peer: peer.rtt_mean > limit
+    return lambda peer: peer.lost > limit
+
+
+class PeerTable(urwid.ListWalker):
+    """The peers of a group as the rows of a ListBox, which only asks
+    for the rows it is going to draw; only those ever get widgets.
+
+    The order is a list of (key, sin), kept sorted: a peer whose key
+    changes is taken out and put back with bisect, rather than the
+    whole lot being sorted again, so the rows at the top are always
+    the worst few by the key. Peers a filter turns away are left out
+    of it altogether.
+
+    Updates only note which peers changed. refresh(), once a frame,
+    moves those that need it and tells the ListBox if any of them moved
+    or are on show; only their rows are filled in again as they are
+    drawn. So however many packets come in, each peer costs no more
+    than once a frame."""
+
+    def __init__(self, cols):
+        super(PeerTable, self).__init__()
+        self.cols = cols
+        self.focus = 0
+        self.peers = {}         # sin -> peer
+        self._keys = {}         # sin -> key, of those in _order
+        self._order = []
+        self._widgets = {}      # sin -> row, of those drawn lately
+        self._stale = set()     # of those, the ones whose peer changed
+        self._dirty = set()     # sins updated since the last refresh()
+        self._sort = SORTS[0]
+        self._filter = None
+        self.filter_text = ''
+
+    def __len__(self):
+        return len(self._order)
+
+    @property
+    def sort_name(self):
+        return self._sort[0]
+
+    def _key(self, peer):
+        return (self._sort[1](peer), peer.sin)
+
+    def _place(self, peer):
+        """Put peer where it belongs in the order; True if it moved"""
+        sin = peer.sin
+        old = self._keys.get(sin)
+        if self._filter is not None and not self._filter(peer):
+            key = None
+        else:
+            key = self._key(peer)
+        if key == old:
+            return False
+        if old is not None:
+            del(self._order[bisect.bisect_left(self._order, (old, sin))])
+            del(self._keys[sin])
+        if key is not None:
+            bisect.insort(self._order, (key, sin))
+            self._keys[sin] = key
+        return True
+
+    def _rebuild(self):
+        self._keys = {}
+        self._order = []
+        for peer in self.peers.itervalues():
+            if self._filter is None or self._filter(peer):
+                self._keys[peer.sin] = self._key(peer)
+        self._order = sorted((key, sin) for (sin, key) in self._keys.iteritems())
+        self.focus = 0
+        self._modified()
+
+    def add(self, peer):
+        if peer.sin in self.peers:
+            return
+        self.peers[peer.sin] = peer
+        self._place(peer)
+        self._modified()
+
+    def update(self, peer):
+        if peer.sin in self.peers:
+            self._dirty.add(peer.sin)
+
+    def refresh(self):
+        """Move the peers updated since the last time, and let the
+        ListBox know if that changes anything it shows; True if so"""
+        changed = False
+        for sin in self._dirty:
+            peer = self.peers.get(sin)
+            if peer is None:
+                continue
+            if self._place(peer):
+                changed = True
+            if sin in self._widgets:
+                self._stale.add(sin)
+                changed = True
+        self._dirty.clear()
+        if changed:
+            self._modified()
+        return changed
+
+    def remove(self, peer):
+        sin = peer.sin
+        if self.peers.pop(sin, None) is None:
+            return
+        key = self._keys.pop(sin, None)
+        if key is not None:
+            del(self._order[bisect.bisect_left(self._order, (key, sin))])
+        self._widgets.pop(sin, None)
+        self._stale.discard(sin)
+        self._dirty.discard(sin)
+        self._modified()
+
+    def next_sort(self):
+        i = SORTS.index(self._sort)
+        self._sort = SORTS[(i + 1) % len(SORTS)]
+        self._rebuild()
+
+    def set_filter(self, text):
+        self.filter_text = text
+        self._filter = _row_filter(text) if text else None
+        self._rebuild()
+
+    def _row(self, sin):
+        """The row for sin, filled in from the peer as it is now"""
+        w = self._widgets.get(sin)
+        if w is not None:
+            if sin not in self._stale:
+                return w
+            self._stale.discard(sin)
+        else:
+            if len(self._widgets) >= ROW_CACHE:
+                self._widgets.clear()
+                self._stale.clear()
+            w = self._widgets[sin] = urwid.Columns([('weight', weight, urwid.Text(''))
+                    for (label, descr, fmt, weight) in self.cols])
+        peer = self.peers[sin]
+        for (i, (label, descr, fmt, weight)) in enumerate(self.cols):
+            if label == 'addr':
+                text = repr(sin)
+            else:
+                text = fmt % getattr(peer, label)
+            w.contents[i][0].set_text(text)
+        return w
+
+    def __getitem__(self, position):
+        if position < 0 or position >= len(self._order):
+            raise IndexError(position)
+        return self._row(self._order[position][1])
+
+    def get_focus(self):
+        if not self._order:
+            return (None, None)
+        self.focus = min(self.focus, len(self._order) - 1)
+        return (self[self.focus], self.focus)
+
+    def set_focus(self, position):
+        self.focus = position
+        self._modified()
+
+    def next_position(self, position):
+        return position + 1
+
+    def prev_position(self, position):
+        return position - 1
+
 
 class UI(object):
     client = False
@@ -39,30 +233,39 @@ class UI(object):
         ('addr', 'Address',   '%s', 3,),
         ('sent', 'Pkts Sent', '%d', 1,),
         ('rcvd', 'Pkts Rcvd', '%d', 1,),
-        ('lost', 'Acks Lost', '%d', 1,),
-        ('rtt',  'Avg RTT',   '%f', 1,),
+        ('lost', 'Lost',      '%d', 1,),
+        ('reordered', 'Reordered', '%d', 1,),
+        ('duplicates', 'Dups',  '%d', 1,),
+        ('rtt_mean', 'Mean RTT', '%f', 1,),
+        ('rtt_p99', 'p99 RTT', '%f', 1,),
+        ('jitter', 'Jitter',  '%f', 1,),
+        ('offset', 'Offset',  '%f', 1,),
+        ('queueing', 'Queue f/b', '%s', 2,),
+        ('rx_delay', 'Rx delay', '%f', 1,),
     ]
 
-    _peers = {}
-    _group = {}
-
     def __init__(self, client=False, server=False, parent=None,
-            force_curses=False, log_lines=None):
+            force_curses=False, log_lines=None, fps=None):
         super(UI, self).__init__()
 
         self.client = client
         self.server = server
         self.parent = parent
+        self.fps = fps or FRAME_RATE
 
         if log_lines is not None:
             self.log_lines = log_lines
-            
+
+        # What has changed since the screen was last drawn
+        self._log_pending = collections.deque(maxlen=self.log_lines + 1)
+        self._dirty_servers = {}    # sin -> peer
+        self._frame_due = False
+        self._frame_ts = 0
+        self._redraw = False
+
         # Initialize the UI elements
         root = self._buildui()
 
-        self._peers['client'] = []
-        self._peers['server'] = []
-
         # The screen for the UI
         # https://docs.python.org/2/library/sys.html#sys.platform
         if force_curses or sys.platform == 'win32': # Does not include Cygwin
@@ -77,8 +280,8 @@ class UI(object):
             self._event_loop = EventletEventLoop()
 
         def sigint(signal, frame):
-            if self._mainloop is not None:
-                self._mainloop.event_loop.running = False
+            if self._mainloop is not None and self._event_loop is not None:
+                self._event_loop.stop()
 
         try: signal.signal(signal.SIGINT, sigint)
         except: pass
@@ -90,9 +293,23 @@ class UI(object):
 
             # Handle our keypresses
             def inkey(key):
+                if self._root.focus_position == 'header':
+                    # Typing a filter
+                    if key == 'enter':
+                        self._set_filter(self._filter_edit.edit_text)
+                    elif key == 'esc':
+                        self._set_filter('')
+                    return False
                 self.log('inkey=%s' % key)
                 if key in ('q', 'Q'):
                     raise urwid.ExitMainLoop()
+                elif key in ('s', 'S'):
+                    self._table.next_sort()
+                    self._show_view()
+                elif key == '/':
+                    self._filter_edit.set_edit_text(self._table.filter_text)
+                    self._root.header = self._filter_header
+                    self._root.focus_position = 'header'
                 return False
 
             # Build the UI mainloop
@@ -104,14 +321,7 @@ class UI(object):
                     unhandled_input=inkey,
                     handle_mouse=False)
             self._root = root
-
-            if self._event_loop is None:
-                def draw_screen():
-                    if self._mainloop is not None:
-                        self._mainloop.draw_screen()
-                        eventlet.spawn_after(1, draw_screen)
-
-                eventlet.spawn_after(1, draw_screen)
+            self._changed()
 
             # This runs the UI loop - it only returns when we're exiting
             self._mainloop.run()
@@ -129,7 +339,7 @@ class UI(object):
 
             # Signal the parent that we're stopping
             if self.parent is not None:
-                self.parent.running = False
+                self.parent.stop()
                 self.parent = None
 
         # Start the UI thread
@@ -153,16 +363,20 @@ class UI(object):
         table_header = urwid.AttrMap(urwid.Columns(hcols), 'table header')
         parts.append(('pack', table_header))
 
-        # Client and server sections
-        self._group = {
-            'client': urwid.Pile([]),
-            'server': urwid.Pile([]),
-        }
-        parts.append(('pack', urwid.AttrMap(self._group['server'], 'table server')))
-        parts.append(urwid.AttrMap(self._group['client'], 'table client'))
-        
+        # Client and server sections; there are only ever a few
+        # servers, but there can be thousands of clients
+        self._servers = urwid.Pile([])
+        self._server_rows = {}  # sin -> row
+        self._table = PeerTable(self.cols)
+        parts.append(('pack', urwid.AttrMap(self._servers, 'table server')))
+        parts.append(urwid.AttrMap(urwid.ListBox(self._table), 'table client'))
+
         body = urwid.AttrMap(urwid.Pile(parts), 'body')
 
+        # Replaces the header while a filter is typed in
+        self._filter_edit = urwid.Edit("Filter (rtt>secs, loss>n or address; esc clears): ")
+        self._filter_header = urwid.AttrMap(self._filter_edit, 'header')
+
         # Logging output footer
         self._log = urwid.SimpleFocusListWalker([])
         log = urwid.ListBox(self._log)
@@ -177,6 +391,7 @@ class UI(object):
         self._address = urwid.Text("")
         self._stuntype = urwid.Text("")
         self._stunaddress = urwid.Text("")
+        self._view = urwid.Text("")
 
         self.set_address('Unknown', None)
         self.set_stun('Unknown', 'Unknown', None)
@@ -186,6 +401,7 @@ class UI(object):
             self._address,
             self._stuntype,
             self._stunaddress,
+            self._view,
         ])
         status_footer = urwid.AttrMap(status_footer, 'log')
 
@@ -195,59 +411,115 @@ class UI(object):
         ])
         footer = urwid.AttrMap(footer, 'footer')
 
+        self._frame_header = header
+        self._show_view()
+
         return urwid.Frame(body, header=header, footer=footer)
 
-    def log(self, text, stdout=False, indent=''):
+    def _show_view(self):
+        table = self._table
+        text = "Clients: %d, by %s" % (len(table.peers), table.sort_name)
+        if table.filter_text:
+            text += ", %d match %s" % (len(table), table.filter_text)
+        self._view.set_text(text)
+
+    def _changed(self, redraw=True):
+        """Something is to be shown; draw it in the next frame, which is
+        as soon as we can without going over fps frames a second. Peer
+        table updates leave redraw to the table, which knows whether
+        they are on screen."""
+        self._redraw = self._redraw or redraw
+        if self._frame_due:
+            return
+        self._frame_due = True
+        delay = self._frame_ts + 1.0 / self.fps - time.time()
+        eventlet.spawn_after(max(0, delay), self._frame)
+
+    def _frame(self):
+        """Put everything that changed since the last frame on the
+        screen, in one go"""
+        self._frame_due = False
+        self._frame_ts = time.time()
+        (redraw, self._redraw) = (self._redraw, False)
+
+        for (sin, peer) in self._dirty_servers.iteritems():
+            row = self._server_rows.get(sin)
+            if row is not None:
+                self._fill(row, peer)
+        self._dirty_servers.clear()
+        if self._table.refresh():
+            redraw = True
+
+        if self._log_pending:
+            # Only now are the messages that made it this far formatted
+            lines = []
+            for (indent, text) in self._log_pending:
+                lines.extend(indent + line for line in str(text).split("\n"))
+            self._log_pending.clear()
+            self._log.extend([urwid.Text(line) for line in lines[-(self.log_lines + 1):]])
+            excess = len(self._log) - (self.log_lines + 1)
+            if excess > 0:
+                del(self._log[:excess])
+            self._log.set_focus(len(self._log)-1)
+
+        if redraw and self._mainloop is not None:
+            self._mainloop.draw_screen()
+
+    def _set_filter(self, text):
+        self._table.set_filter(text.strip())
+        self._root.header = self._frame_header
+        self._root.focus_position = 'body'
+        self._show_view()
+
+    def log(self, text, stdout=False, indent='', level=None, ts=None):
         """Send a log message to the logging part of the UI"""
 
         if stdout:
             print(text)
 
-        for line in text.split("\n"):
-            while len(self._log) > self.log_lines:
-                self._log.pop(0)
-            self._log.append(urwid.Text(indent + line))
-
-        self._log.set_focus(len(self._log)-1)
-
-        #if self._mainloop is not None:
-            #self._mainloop.draw_screen()
+        self._log_pending.append((indent, text))
+        self._changed()
 
     def title(self, text, stdout=False):
         """Set page title"""
         if stdout:
             print(text)
         self._header.set_text(text)
+        self._changed()
 
-    def _find_peer(self, group, sin):
-        index = 0
-        for peer in self._peers[group]:
-            if peer == sin:
-                return index 
-            index += 1
-        return None
-
-    def peer_update(self, group, sin, stats):
-        if 'sent' in stats and 'rcvd' in stats:
-            stats['lost'] = stats['sent'] - stats['ackd']
-            if stats['lost'] < 0: stats['lost'] = 0
-
-        index = self._find_peer(group, sin)
-        if index is None:
-            return
-
+    def _fill(self, row, peer):
         colnum = -1
         for col in self.cols:
             (label, descr, fmt, weight) = col
             colnum += 1
             if label in ('addr',):
                 continue
-            if label in stats:
-                text = fmt % stats[label]
-                self._group[group][index][colnum].set_text(text)
+            text = fmt % getattr(peer, label)
+            row[colnum].set_text(text)
+
+    def peer_update(self, group, peer):
+        if group == 'client':
+            self._table.update(peer)
+            redraw = False
+        elif peer.sin in self._server_rows:
+            self._dirty_servers[peer.sin] = peer
+            redraw = True
+        else:
+            return
+        if not self._frame_due:
+            self._changed(redraw)
+        elif redraw:
+            self._redraw = True
+
+    def peer_add(self, group, peer):
+        if group == 'client':
+            self._table.add(peer)
+            self._show_view()
+            self._changed()
+            return
 
-    def peer_add(self, group, sin):
-        if self._find_peer(group, sin) is not None:
+        sin = peer.sin
+        if sin in self._server_rows:
             return
 
         hcols = []
@@ -263,23 +535,33 @@ class UI(object):
 
         te = urwid.Columns(hcols)
 
-        self._peers[group].append(sin)
-        self._group[group].contents.append((te, ('pack', None)))
+        self._server_rows[sin] = te
+        self._servers.contents.append((te, ('pack', None)))
+        self._changed()
 
-    def peer_del(self, group, sin):
-        index = self._find_peer(group, sin)
+    def peer_del(self, group, peer):
+        if group == 'client':
+            self._table.remove(peer)
+            self._show_view()
+            self._changed()
+            return
 
-        if index is None:
+        row = self._server_rows.pop(peer.sin, None)
+        if row is None:
             return
 
-        self._peers[group].pop(index)
-        self._group[group].contents.pop(index)
+        for (i, (w, options)) in enumerate(self._servers.contents):
+            if w is row:
+                del(self._servers.contents[i])
+                break
+        self._changed()
 
     def set_address(self, address, port):
         addr = str(address)
         if port:
             addr = "%s:%d" % (addr, int(port))
         self._address.set_text("Address: %s" % addr)
+        self._changed()
 
     def set_stun(self, nat_type, external_ip, external_port):
         self._stuntype.set_text("NAT type: %s" % str(nat_type))
@@ -287,4 +569,5 @@ class UI(object):
         #if external_port:
         #    addr = "%s:%d" % (addr, int(external_port))
         self._stunaddress.set_text("NAT address: %s" % addr)
+        self._changed()
 
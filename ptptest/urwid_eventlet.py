@@ -1,18 +1,23 @@
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
-# 
+#
 # Copyright (c) 2014 Chris Luke <chrisy@flirble.org>
-# 
+#
 """
 Urwid extensions: Eventlet main loop implementation
 """
 
-import sys, heapq, eventlet, select, errno, urwid
-from eventlet.green import time
+import sys, errno, signal, eventlet, eventlet.event, urwid
+from eventlet.hubs import trampoline
 
 
 class EventletEventLoop(object):
     """
     Event loop based on :func:`Eventlet`
+
+    Nothing here polls: alarms are hub timers, each watched file has a
+    greenlet waiting on the hub for it to become readable, and the idle
+    callbacks are run once after each burst of callbacks. When nothing
+    is happening, the loop does not wake up at all.
     """
 
     running = False
@@ -20,12 +25,12 @@ class EventletEventLoop(object):
     def __init__(self):
         super(EventletEventLoop, self).__init__()
 
-        self._alarms = []
+        self._alarms = set()
         self._watch_files = {}
-        self._poll = select.poll()
         self._idle_handle = 0
         self._idle_callbacks = {}
-        self._idle_ts = 0
+        self._idle_due = False
+        self._exit = None
         self.running = False
 
     def alarm(self, seconds, callback):
@@ -38,8 +43,12 @@ class EventletEventLoop(object):
         seconds -- floating point time to wait before calling callback
         callback -- function to call from event loop
         """
-        handle = eventlet.spawn_after(seconds, callback)
-        heapq.heappush(self._alarms, handle)
+        def fire():
+            self._alarms.discard(handle)
+            self._call(callback)
+
+        handle = eventlet.spawn_after(max(0, seconds), fire)
+        self._alarms.add(handle)
         return handle
 
     def remove_alarm(self, handle):
@@ -48,13 +57,11 @@ class EventletEventLoop(object):
 
         Returns True if the alarm exists, False otherwise
         """
-        try:
-            handle.cancel()
-            self._alarms.remove(handle)
-            heapq.heapify(self._alarms)
-            return True
-        except ValueError:
+        if handle not in self._alarms:
             return False
+        self._alarms.discard(handle)
+        handle.cancel()
+        return True
 
     def watch_file(self, fd, callback):
         """
@@ -66,9 +73,8 @@ class EventletEventLoop(object):
         fd -- file descriptor to watch for input
         callback -- function to call when input is available
         """
-        self._watch_files[fd] = callback
-        self._poll.register(fd, select.POLLIN)
-
+        self.remove_watch_file(fd)
+        self._watch_files[fd] = eventlet.spawn(self._watch, fd, callback)
         return fd
 
     def remove_watch_file(self, handle):
@@ -77,12 +83,27 @@ class EventletEventLoop(object):
 
         Returns True if the input file exists, False otherwise
         """
-        if handle in self._watch_files:
-            self._poll.unregister(handle)
-            del self._watch_files[handle]
-            return True
+        gt = self._watch_files.pop(handle, None)
+        if gt is None:
+            return False
+        # A callback may remove its own file; its greenlet notices, and
+        # stops, when the callback returns
+        if gt is not eventlet.getcurrent():
+            gt.kill()
+        return True
 
-        return False
+    def _watch(self, fd, callback):
+        me = eventlet.getcurrent()
+        while self._watch_files.get(fd) is me:
+            try:
+                trampoline(fd, read=True)
+            except IOError, e:
+                # A plain file (or /dev/null) cannot be waited on; nor
+                # will input ever arrive from it while we wait
+                if e.errno != errno.EPERM:
+                    raise
+                return
+            self._call(callback)
 
     def enter_idle(self, callback):
         """
@@ -106,57 +127,70 @@ class EventletEventLoop(object):
             return False
         return True
 
+    def _idle_soon(self):
+        """
+        Have the idle callbacks run once whatever else is ready has had
+        its turn.
+        """
+        if not self._idle_due:
+            self._idle_due = True
+            eventlet.spawn(self._entering_idle)
+
     def _entering_idle(self):
         """
         Call all the registered idle callbacks.
         """
+        self._idle_due = False
         for callback in self._idle_callbacks.values():
-            callback()
-            eventlet.sleep(0.01)
-        self._idle_ts = time.time()
+            if not self._call(callback, idle=False):
+                break
 
-    def run(self):
+    def _call(self, callback, idle=True):
         """
-        Start the event loop.  Exit the loop when any callback raises
-        an exception.  If ExitMainLoop is raised, exit cleanly.
+        Run a callback, stopping the loop if it raises; returns False
+        if it did.
         """
+        try:
+            callback()
+        except urwid.ExitMainLoop:
+            self.stop()
+            return False
+        except Exception:
+            self.stop(sys.exc_info())
+            return False
+        if idle:
+            self._idle_soon()
+        return True
 
-        self.running = True
-
-        eventlet.spawn(self._task);
-
-        # This can be done much much better...
-        while self.running:
-            eventlet.sleep(0.75)
-
-    def _task(self):
-        while self.running:
-            try:
-                self._loop()
-                eventlet.sleep(0.01)
-            except select.error, e:
-                print "oooh"
-                if e.args[0] != errno.EINTR:
-                    # not just something we need to retry
-                    raise
-            except urwid.ExitMainLoop:
-                self.running = False
-
-
-    def _loop(self):
+    def set_signal_handler(self, signum, handler):
         """
-        A single iteration of the event loop
+        Sets the signal handler for signal signum; the handlers run
+        wherever the signal finds us, so should do no more than urwid's
+        own, which write to a pipe we are watching.
         """
-        ready = self._poll.poll(0)
-        if ready is not None and len(ready):
-            for fd, event in ready:
-                if event == select.POLLIN:
-                    self._watch_files[fd]()
-        else:
-            self._entering_idle()
-
-        # Make sure idle cb's don't get starved
-        if time.time() - self._idle_ts > 0.5:
-            self._entering_idle()
+        return signal.signal(signum, handler)
 
+    def stop(self, exc_info=None):
+        """
+        Make run() return, or raise exc_info if given; safe to call from
+        a signal handler.
+        """
+        if self._exit is not None and not self._exit.ready():
+            if exc_info is not None:
+                self._exit.send_exception(*exc_info)
+            else:
+                self._exit.send(None)
 
+    def run(self):
+        """
+        Start the event loop.  Exit the loop when any callback raises
+        an exception.  If ExitMainLoop is raised, exit cleanly.
+        """
+        self._exit = eventlet.event.Event()
+        self.running = True
+        self._idle_soon()
+        try:
+            self._exit.wait()
+        finally:
+            self.running = False
+            self._exit = None
@@ -0,0 +1,77 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+# Copyright (c) 2014 Chris Luke <chrisy@flirble.org>
+#
+"""Hashed timer wheel"""
+
+import math
+
+
+class TimerWheel(object):
+    """A hashed timer wheel of keys and deadlines.
+
+    Keys are hashed into slots by the tick their deadline falls in, so
+    rescheduling a key is O(1) and expire() only looks at the slots for
+    the ticks that have passed. Deadlines more than one revolution away
+    simply stay put until their slot comes around enough times."""
+
+    def __init__(self, resolution=1.0, slots=64):
+        super(TimerWheel, self).__init__()
+        self.resolution = float(resolution)
+        self._slots = [set() for i in xrange(slots)]
+        self._when = {}     # key -> tick
+        self._tick = None   # last tick expire() looked at
+
+    def __len__(self):
+        return len(self._when)
+
+    def __contains__(self, key):
+        return key in self._when
+
+    def _tickof(self, deadline):
+        # Round up, so a key is never in a slot before its deadline
+        tick = int(math.ceil(deadline / self.resolution))
+        if self._tick is not None and tick <= self._tick:
+            tick = self._tick + 1
+        return tick
+
+    def schedule(self, key, deadline):
+        """Set (or move) the deadline for key"""
+        tick = self._tickof(deadline)
+        old = self._when.get(key)
+        if old == tick:
+            return
+        n = len(self._slots)
+        if old is not None:
+            self._slots[old % n].discard(key)
+        self._slots[tick % n].add(key)
+        self._when[key] = tick
+
+    def cancel(self, key):
+        """Forget about key"""
+        tick = self._when.pop(key, None)
+        if tick is not None:
+            self._slots[tick % len(self._slots)].discard(key)
+
+    def expire(self, now):
+        """Remove and return the keys whose deadline is at or before now"""
+        tick = int(math.floor(now / self.resolution))
+        if self._tick is None:
+            self._tick = tick - len(self._slots)
+        if tick <= self._tick:
+            return []
+
+        n = len(self._slots)
+        first = max(self._tick + 1, tick - n + 1)
+        self._tick = tick
+
+        due = []
+        for t in xrange(first, tick + 1):
+            slot = self._slots[t % n]
+            if not slot:
+                continue
+            for key in [key for key in slot if self._when[key] <= tick]:
+                slot.discard(key)
+                del(self._when[key])
+                due.append(key)
+        return due
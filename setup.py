@@ -38,7 +38,7 @@ setup(
     author_email='chrisy@flirble.org',
     packages=packages,
     include_package_data = True,
-    scripts = ['ptpserver', 'ptpclient'],
+    scripts = ['ptpserver', 'ptpclient', 'ptpload'],
     url = 'https://github.com/chrisy/ptptest',
 
     package_data = {